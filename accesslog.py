@@ -0,0 +1,149 @@
+import re
+import threading
+import time
+from collections import namedtuple
+
+ACCESS_PATTERN = re.compile(
+    r'^(?P<timestamp>\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2})(?:\.\d+)? '
+    r'(?:from )?(?:(?:tcp|udp):)?(?P<source>\[[0-9a-fA-F:.]+\]|[^\s:\[]+):\d+ '
+    r'(?P<status>accepted|rejected)\s+(?P<destination>\S+)?'
+    r'(?: \[(?P<inbound>[^\]]+?) (?:>>|->) (?P<outbound>[^\]]+)\])?'
+    r'(?: email: (?P<email>\S+))?'
+)
+
+AccessRecord = namedtuple(
+    'AccessRecord',
+    ('timestamp', 'source', 'destination', 'inbound', 'outbound', 'email', 'accepted')
+)
+
+
+class AccessLogParser(object):
+    """Turns Xray access log lines into AccessRecords, other lines are skipped"""
+
+    def __init__(self):
+        self._last_timestamp = (None, 0)
+
+    def _timestamp(self, value: str) -> float:
+        # lines come in bursts within the same second, don't parse the same timestamp twice
+        if self._last_timestamp[0] != value:
+            self._last_timestamp = (value, time.mktime(time.strptime(value, '%Y/%m/%d %H:%M:%S')))
+        return self._last_timestamp[1]
+
+    def parse(self, line: str):
+        if ' accepted ' not in line and ' rejected ' not in line:
+            return
+        m = ACCESS_PATTERN.match(line)
+        if not m:
+            return
+
+        accepted = m.group('status') == 'accepted'
+        destination = m.group('destination') if accepted else None
+        if destination and destination[:4] in ('tcp:', 'udp:'):
+            destination = destination[4:]
+
+        return AccessRecord(
+            timestamp=self._timestamp(m.group('timestamp')),
+            source=m.group('source').strip('[]'),
+            destination=destination,
+            inbound=m.group('inbound'),
+            outbound=m.group('outbound'),
+            email=m.group('email'),
+            accepted=accepted
+        )
+
+
+class AccessAggregator(object):
+    """
+    Keeps rolling access log aggregates in bounded memory:
+    last seen time and source IPs of every user seen in the last ip_window seconds (at most max_ips_per_user each)
+    and approximate top destinations (at most max_destinations counters)
+    """
+
+    def __init__(self,
+                 online_window: float = 60,
+                 ip_window: float = 300,
+                 max_ips_per_user: int = 64,
+                 max_destinations: int = 1000):
+        self.online_window = online_window
+        self.ip_window = ip_window
+        self.max_ips_per_user = max_ips_per_user
+        self.max_destinations = max_destinations
+
+        self.parser = AccessLogParser()
+        self.accepted = 0
+        self.rejected = 0
+        self.users = {}
+        self.destinations = {}
+
+        self._last_prune = time.time()
+        self._lock = threading.Lock()
+
+    def add_lines(self, lines: list):
+        records = [record for record in map(self.parser.parse, lines) if record]
+        if records:
+            self.add(records)
+
+    def add(self, records: list):
+        now = time.time()
+        with self._lock:
+            for record in records:
+                if not record.accepted:
+                    self.rejected += 1
+                    continue
+                self.accepted += 1
+
+                if record.email:
+                    ips = self.users.get(record.email)
+                    if ips is None:
+                        ips = self.users[record.email] = {}
+                    ips.pop(record.source, None)
+                    ips[record.source] = now
+                    if len(ips) > self.max_ips_per_user:
+                        # dicts keep insertion order, the first one is the least recently seen
+                        del ips[next(iter(ips))]
+
+                if record.destination:
+                    self.destinations[record.destination] = self.destinations.get(record.destination, 0) + 1
+
+            if len(self.destinations) > 2 * self.max_destinations:
+                top = sorted(self.destinations.items(), key=lambda item: item[1], reverse=True)
+                self.destinations = dict(top[:self.max_destinations])
+
+            if now - self._last_prune > 10:
+                self._prune(now)
+
+    def _prune(self, now: float):
+        self._last_prune = now
+        expire = now - self.ip_window
+        for email in list(self.users):
+            ips = self.users[email]
+            for ip in [ip for ip, seen in ips.items() if seen < expire]:
+                del ips[ip]
+            if not ips:
+                del self.users[email]
+
+    def user_ips(self, email: str, window: float = None) -> list:
+        expire = time.time() - (window or self.ip_window)
+        with self._lock:
+            return [ip for ip, seen in self.users.get(email, {}).items() if seen >= expire]
+
+    def summary(self, limit: int = 20) -> dict:
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            online = {}
+            for email, ips in self.users.items():
+                last_seen = max(ips.values())
+                if now - last_seen <= self.online_window:
+                    online[email] = {
+                        "last_seen": round(last_seen),
+                        "ips": list(ips)
+                    }
+            top = sorted(self.destinations.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+            return {
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "online": online,
+                "top_destinations": [{"destination": d, "count": c} for d, c in top]
+            }
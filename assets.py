@@ -0,0 +1,195 @@
+import hashlib
+import os
+import re
+import threading
+import time
+
+UPLOADS_DIR = '.uploads'
+MAX_ASSET_SIZE = 512 * 1024 * 1024
+STALE_UPLOAD_AGE = 24 * 3600
+HASH_CHUNK_SIZE = 1024 * 1024
+
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-][A-Za-z0-9_.-]*$')
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+class AssetError(ValueError):
+    pass
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class AssetStore(object):
+    """
+    Keeps the files of Xray's assets directory (geoip.dat, geosite.dat, ...) in sync with the panel
+    uploads are addressed by the sha256 of the whole file and staged in .uploads in the assets directory,
+    a staged upload survives disconnects and node restarts so it resumes from it's current size,
+    it's installed by renaming it over the live file once it's size and hash match
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.uploads_path = os.path.join(path, UPLOADS_DIR)
+
+        # sha256 of files by (name, mtime, size), so the manifest only hashes changed files
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _check_name(name: str):
+        if not isinstance(name, str) or not NAME_PATTERN.match(name):
+            raise AssetError(f'Invalid asset name "{name}"')
+
+    @staticmethod
+    def _check_hash(sha256: str):
+        if not isinstance(sha256, str) or not SHA256_PATTERN.match(sha256):
+            raise AssetError(f'Invalid sha256 "{sha256}", must be 64 lowercase hex digits')
+
+    def _part_path(self, sha256: str, size: int) -> str:
+        return os.path.join(self.uploads_path, f'{sha256}-{size}.part')
+
+    def _hash(self, name: str, stat: os.stat_result) -> str:
+        key = (name, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            sha256 = self._hashes.get(key)
+        if sha256 is None:
+            sha256 = file_sha256(os.path.join(self.path, name))
+            with self._lock:
+                for old_key in [k for k in self._hashes if k[0] == name]:
+                    del self._hashes[old_key]
+                self._hashes[key] = sha256
+        return sha256
+
+    def manifest(self) -> dict:
+        """Returns {name: {"sha256", "size", "modified"}} of every file in the assets directory"""
+        assets = {}
+        try:
+            entries = list(os.scandir(self.path))
+        except FileNotFoundError:
+            return assets
+
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            stat = entry.stat()
+            try:
+                sha256 = self._hash(entry.name, stat)
+            except FileNotFoundError:  # removed while listing
+                continue
+            assets[entry.name] = {
+                "sha256": sha256,
+                "size": stat.st_size,
+                "modified": int(stat.st_mtime)
+            }
+        return assets
+
+    def _remove_stale_uploads(self):
+        now = time.time()
+        try:
+            entries = list(os.scandir(self.uploads_path))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            try:
+                if now - entry.stat().st_mtime > STALE_UPLOAD_AGE:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def begin_upload(self, name: str, sha256: str, size: int) -> dict:
+        """
+        Starts or resumes an upload, returns {"status": "exists"} if the live file already has the hash
+        otherwise {"status": "uploading", "offset": bytes already staged} to send the rest from
+        """
+        self._check_name(name)
+        self._check_hash(sha256)
+        if not isinstance(size, int) or not 0 <= size <= MAX_ASSET_SIZE:
+            raise AssetError(f"Asset size must be at least 0 and at most {MAX_ASSET_SIZE} bytes")
+
+        try:
+            stat = os.stat(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+        else:
+            if stat.st_size == size and self._hash(name, stat) == sha256:
+                return {"status": "exists", "offset": size}
+
+        self._remove_stale_uploads()
+        os.makedirs(self.uploads_path, exist_ok=True)
+        part_path = self._part_path(sha256, size)
+        with open(part_path, 'ab') as f:
+            offset = f.tell()
+        return {"status": "uploading", "offset": offset}
+
+    def write_chunk(self, sha256: str, size: int, offset: int, data: bytes) -> dict:
+        """
+        Writes data at offset of a staged upload and returns the new offset,
+        resent chunks that were already written are skipped so retries are safe
+        """
+        self._check_hash(sha256)
+        part_path = self._part_path(sha256, size)
+
+        with self._lock:
+            try:
+                current = os.path.getsize(part_path)
+            except FileNotFoundError:
+                raise AssetError("Upload was not started or has expired, start it again")
+
+            if offset > current:
+                raise AssetError(f"Chunk offset {offset} is past the staged {current} bytes")
+            data = data[current - offset:]
+            if current + len(data) > size:
+                raise AssetError(f"Chunk goes past the asset size of {size} bytes")
+
+            if data:
+                with open(part_path, 'ab') as f:
+                    f.write(data)
+                current += len(data)
+
+        return {"offset": current}
+
+    def install(self, name: str, sha256: str, size: int) -> dict:
+        """
+        Verifies a fully staged upload and renames it over the live file,
+        raises AssetError and drops the upload if it's hash doesn't match
+        """
+        self._check_name(name)
+        self._check_hash(sha256)
+        part_path = self._part_path(sha256, size)
+
+        with self._lock:
+            try:
+                staged = os.path.getsize(part_path)
+            except FileNotFoundError:
+                raise AssetError("Upload was not started or has expired, start it again")
+            if staged != size:
+                raise AssetError(f"Upload is incomplete, {staged} of {size} bytes staged")
+
+            actual = file_sha256(part_path)
+            if actual != sha256:
+                os.unlink(part_path)
+                raise AssetError(f"Upload doesn't match it's sha256, got {actual}, start it again")
+
+            with open(part_path, 'rb') as f:
+                os.fsync(f.fileno())
+            os.chmod(part_path, 0o644)
+            # .uploads is in the assets directory, so the rename never crosses filesystems
+            os.replace(part_path, os.path.join(self.path, name))
+
+            stat = os.stat(os.path.join(self.path, name))
+            for old_key in [k for k in self._hashes if k[0] == name]:
+                del self._hashes[old_key]
+            self._hashes[(name, stat.st_mtime_ns, stat.st_size)] = sha256
+
+        return {
+            "name": name,
+            "sha256": sha256,
+            "size": size,
+            "modified": int(stat.st_mtime)
+        }
@@ -0,0 +1,82 @@
+"""
+Hot user changes: checks how the API's errors are mapped against the fake gRPC API,
+a user already added or already removed is fine but an inbound Xray doesn't have must fail,
+then measures users added and removed per second through XRayCore.alter_users over the shared channel,
+the fake API is served by this same Python process so the rates are a lower bound of what a real Xray allows
+
+    python benchmarks/bench_alter_users.py [--users N]
+"""
+import argparse
+import time
+
+from common import CERT_FILE, KEY_FILE, WORK_PATH, make_config, make_config_json
+
+from config import XRAY_API_PORT, XRAY_EXECUTABLE_PATH
+from fake_api import FakeXrayAPI
+from xray import XRayConfig, XRayCore
+from xray_api import EmailExistsError, EmailNotFoundError, XRayAPIError, build_account
+
+
+def check_errors(core: XRayCore):
+    account = build_account('vless', {"id": f"{0:032x}"})
+    try:
+        core.api.add_inbound_user('inbound0', 'user0', account)
+    except EmailExistsError:
+        pass
+    else:
+        raise AssertionError("Adding an existing user didn't raise EmailExistsError")
+
+    try:
+        core.api.remove_inbound_user('inbound0', 'nobody')
+    except EmailNotFoundError:
+        pass
+    else:
+        raise AssertionError("Removing a missing user didn't raise EmailNotFoundError")
+
+    try:
+        core.api.remove_inbound_user('inbound1', 'user1')
+    except (EmailExistsError, EmailNotFoundError) as exc:
+        raise AssertionError(f"A missing handler was taken for a missing user: {exc}")
+    except XRayAPIError:
+        pass
+
+    # inbound1 is in the config but not in Xray, removing from it must not count as removed
+    result = core.alter_users({"inbound1": {"remove": ["user1"]}})
+    assert result["removed"] == 0 and len(result["errors"]) == 1, result
+    assert any(client['email'] == 'user1' for client in core.config.get_inbound('inbound1')['settings']['clients'])
+    print("error mapping ok:", result["errors"][0]["error"])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5000)
+    args = parser.parse_args()
+
+    config = make_config(2, 2)
+    api = FakeXrayAPI({"inbound0": {"user0"}}).start(XRAY_API_PORT, CERT_FILE, KEY_FILE)
+    core = XRayCore(executable_path=XRAY_EXECUTABLE_PATH, assets_path=WORK_PATH)
+    core.start(XRayConfig(make_config_json(2, 2), '127.0.0.1'))
+    try:
+        core.wait_ready(10)
+        check_errors(core)
+
+        clients = [{"id": f"{i:032x}", "email": f"new{i}", "flow": "xtls-rprx-vision"} for i in range(args.users)]
+        start = time.perf_counter()
+        result = core.alter_users({"inbound0": {"add": clients}})
+        added = time.perf_counter() - start
+        assert result["added"] == args.users and not result["errors"], result
+
+        start = time.perf_counter()
+        result = core.alter_users({"inbound0": {"remove": [client['email'] for client in clients]}})
+        removed = time.perf_counter() - start
+        assert result["removed"] == args.users and not result["errors"], result
+        assert core.config.get_inbound('inbound0')['settings']['clients'] == config['inbounds'][0]['settings']['clients']
+    finally:
+        core.stop()
+        api.stop()
+
+    print(f"{args.users} users: added {args.users / added:,.0f}/s, removed {args.users / removed:,.0f}/s")
+
+
+if __name__ == '__main__':
+    main()
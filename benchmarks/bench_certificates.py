@@ -0,0 +1,84 @@
+"""
+Certificates: generation time of every SSL_KEY_TYPE, the TLS handshake cost with the generated certificate
+and whether the node's gRPC client to the Xray API (BoringSSL) accepts it
+
+    python benchmarks/bench_certificates.py [--handshakes N]
+"""
+import argparse
+import os
+import socket
+import ssl
+import threading
+import time
+
+from common import WORK_PATH
+from fake_api import FakeXrayAPI
+
+from certificate import KEY_TYPES, generate_certificate, write_atomic
+from xray_api import XRayAPI, XRayAPIError
+
+API_PORT = 62170
+
+
+def serve_tls(context: ssl.SSLContext) -> int:
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def accept():
+        while True:
+            connection, _ = listener.accept()
+            try:
+                with context.wrap_socket(connection, server_side=True) as tls:
+                    tls.recv(1)
+            except OSError:
+                pass
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--handshakes', type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"{'key type':11} {'generate':>10} {'handshake':>10}  grpc")
+    for key_type in KEY_TYPES:
+        start = time.perf_counter()
+        pems = generate_certificate(key_type)
+        generated = time.perf_counter() - start
+
+        cert_file = os.path.join(WORK_PATH, f'{key_type}.pem')
+        key_file = os.path.join(WORK_PATH, f'{key_type}.key')
+        write_atomic(key_file, pems['key'], 0o600)
+        write_atomic(cert_file, pems['cert'])
+
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(cert_file, key_file)
+        port = serve_tls(server_context)
+        client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        client_context.load_verify_locations(cert_file)
+        client_context.check_hostname = False
+
+        start = time.perf_counter()
+        for _ in range(args.handshakes):
+            with socket.create_connection(('127.0.0.1', port)) as connection:
+                with client_context.wrap_socket(connection):
+                    pass
+        handshake = (time.perf_counter() - start) / args.handshakes
+
+        api = FakeXrayAPI().start(API_PORT, cert_file, key_file)
+        client = XRayAPI('127.0.0.1', API_PORT, cert_file, timeout=5)
+        try:
+            client.query_stats()
+            grpc_result = "ok"
+        except XRayAPIError as exc:
+            grpc_result = f"failed: {exc.details[:60]}"
+        finally:
+            client.close()
+            api.stop()
+
+        print(f"{key_type:11} {generated * 1000:>8.1f}ms {handshake * 1000:>8.2f}ms  {grpc_result}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Config compilation: parsing, hashing and API injection (XRayConfig()), serialization (to_bytes())
+and an unchanged config sent again (XRayConfig.load() recognizing it, then the diff against the running one)
+with the stdlib json module and with orjson when it's installed, hashing always uses the stdlib one
+
+    python benchmarks/bench_config.py [clients ...]
+"""
+import sys
+import time
+
+from common import make_config_json
+
+import xray
+from xray import XRayConfig
+
+PEER_IP = '127.0.0.1'
+
+
+def measure(raw: str) -> tuple:
+    XRayConfig._serialized_cache.clear()
+
+    start = time.perf_counter()
+    config = XRayConfig(raw, PEER_IP)
+    compiled = time.perf_counter()
+    config.to_bytes()
+    serialized = time.perf_counter()
+
+    unchanged = XRayConfig.load(raw, PEER_IP, config)
+    unchanged.to_bytes()
+    assert config.diff(unchanged) == {}
+    resent = time.perf_counter()
+
+    return compiled - start, serialized - compiled, resent - serialized
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000]
+    backends = [('stdlib', None)]
+    if xray.orjson is not None:
+        backends.append(('orjson', xray.orjson))
+
+    print(f"{'backend':8} {'clients':>8} {'compile':>10} {'serialize':>10} {'unchanged':>10}")
+    for name, module in backends:
+        xray.orjson = module
+        for clients in sizes:
+            raw = make_config_json(clients)
+            # best of 3, the first run also warms up the allocator
+            results = min(measure(raw) for _ in range(3))
+            print(f"{name:8} {clients:>8} " + ' '.join(f"{seconds * 1000:>8.1f}ms" for seconds in results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Enforcement loop: cost of an iteration (reading the stats counters without reset, then checking every limit)
+at 10k limited users against the fake xray and the fake gRPC API, with access log aggregation on,
+then of an iteration removing the users who went over their data limit, and that Xray's counters were left as they were
+CPU is the node's own thread, wall time includes the fake API encoding every counter in Python
+
+    python benchmarks/bench_enforcement.py [--users N] [--violators N]
+"""
+import argparse
+import os
+import time
+
+from common import CERT_FILE, KEY_FILE, WORK_PATH, make_config, make_config_json
+
+os.environ.setdefault("ACCESS_LOG_AGGREGATION", "true")
+
+from config import XRAY_API_PORT, XRAY_EXECUTABLE_PATH  # noqa: E402
+from fake_api import FakeXrayAPI  # noqa: E402
+from xray import XRayConfig, XRayCore  # noqa: E402
+
+ITERATIONS = 10
+INBOUNDS = 3
+
+
+def timed(func: callable) -> tuple:
+    start, cpu_start = time.perf_counter(), time.thread_time()
+    func()
+    return time.perf_counter() - start, time.thread_time() - cpu_start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--violators', type=int, default=100)
+    args = parser.parse_args()
+
+    config = make_config(args.users, INBOUNDS)
+    api = FakeXrayAPI({
+        inbound['tag']: {client['email'] for client in inbound['settings']['clients']}
+        for inbound in config['inbounds']
+    }).start(XRAY_API_PORT, CERT_FILE, KEY_FILE)
+    for i in range(args.users):
+        api.stats[f'user>>>user{i}>>>traffic>>>uplink'] = 1024
+        api.stats[f'user>>>user{i}>>>traffic>>>downlink'] = 4096
+
+    core = XRayCore(executable_path=XRAY_EXECUTABLE_PATH, assets_path=WORK_PATH)
+    # access logs of the first thousand users keep coming in, so their IPs are tracked
+    core._env.update({"FAKE_XRAY_START_DELAY": "0", "FAKE_XRAY_RATE": "5000"})
+    core.enforcer.interval = 0  # iterations are run by hand below
+    core.start(XRayConfig(make_config_json(args.users, INBOUNDS), '127.0.0.1'))
+    try:
+        core.wait_ready(10)
+        time.sleep(1)
+        core.set_user_limits({
+            f'user{i}': {"data_limit": 1024 ** 4, "ip_limit": 3, "expire": time.time() + 86400}
+            for i in range(args.users)
+        })
+
+        checks = []
+        for _ in range(ITERATIONS):
+            checks.append(timed(core.enforcer.check))
+
+        for i in range(args.violators):
+            api.stats[f'user>>>user{i}>>>traffic>>>uplink'] += 1024 ** 4
+        enforced = timed(core.enforcer.check)
+        events = core.get_enforcement_events()["events"]
+    finally:
+        core.stop()
+        api.stop()
+
+    def report(name: str, samples: list):
+        wall, cpu = min(samples)
+        print(f"{name:34} {wall * 1000:8.1f}ms wall {cpu * 1000:8.1f}ms CPU")
+
+    print(f"{args.users} limited users, best of {ITERATIONS}:")
+    report("limits check", checks)
+    report(f"check removing {args.violators} users", [enforced])
+    assert len(events) == args.violators, events
+    assert api.stats[f'user>>>user{args.users - 1}>>>traffic>>>downlink'] == 4096, "counters were reset"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Log filtering: cost per line of every LogFilter criterion on synthetic access log lines,
+and of reading them through the log bus by several filtered subscribers
+
+    python benchmarks/bench_log_filter.py [--lines N] [--subscribers N]
+"""
+import argparse
+import time
+from contextlib import ExitStack
+
+import common  # noqa: F401
+from fake_xray import access_line
+
+from logbus import LogBus
+from logfilter import LogFilter
+
+FILTERS = {
+    "none": {},
+    "level": {"level": "warning"},
+    "email": {"email": "user7"},
+    "inbound": {"inbound": "inbound1"},
+    "contains": {"contains": ["example2.com", "example5.com"]},
+    "regex": {"regex": r"from 10\.0\.1\d\."},
+    "contains+inbound": {"contains": ["example2.com", "example5.com"], "inbound": "inbound1"},
+    "sample": {"sample": 0.1},
+    "max_rate": {"max_rate": 1000},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=100_000)
+    parser.add_argument('--subscribers', type=int, default=10)
+    args = parser.parse_args()
+
+    lines = [access_line(i).decode().rstrip('\n') for i in range(args.lines)]
+    # warnings and errors are rare in practice
+    for i in range(0, len(lines), 100):
+        lines[i] = f"2024/01/01 00:00:01 [Warning] app/dispatcher: failed to process outbound traffic {i}"
+
+    print(f"{'filter':18} {'ns/line':>8} {'kept':>7}")
+    for name, kwargs in FILTERS.items():
+        log_filter = LogFilter(**kwargs) if kwargs else None
+        start = time.perf_counter()
+        kept = log_filter(lines) if log_filter is not None else lines
+        elapsed = time.perf_counter() - start
+        print(f"{name:18} {elapsed / len(lines) * 1e9:>8.0f} {len(kept):>7}")
+
+    bus = LogBus(max_bytes=64 * 1024 * 1024)
+    with ExitStack() as stack:
+        subscribers = [stack.enter_context(bus.subscribe(0, LogFilter(email=f"user{i}")))
+                       for i in range(args.subscribers)]
+        start = time.perf_counter()
+        bus.publish(lines)
+        for subscriber in subscribers:
+            while subscriber:
+                subscriber.read(1000)
+        elapsed = time.perf_counter() - start
+    print(f"publish and read by {args.subscribers} email filtered subscribers: "
+          f"{elapsed / len(lines) * 1e9:.0f} ns/line")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Log ingestion: throughput of the capture thread reading the core's stdout and stderr into the log bus,
+the fake xray writes lines as fast as it can (rate 0) or at a fixed rate, every 10th one to stderr
+reports lines per second and the node's CPU time per million lines,
+at rate 0 the fake xray itself is usually the limit so the CPU time is what tells the node's cost
+
+    python benchmarks/bench_log_ingestion.py [--lines N] [--rate LINES_PER_SECOND]
+"""
+import argparse
+import time
+
+from common import WORK_PATH, make_config_json
+
+from config import XRAY_EXECUTABLE_PATH
+from xray import XRayConfig, XRayCore
+
+# the version banner and the started line come before the access logs
+STARTUP_LINES = 2
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=1_000_000)
+    parser.add_argument('--rate', type=float, default=0)
+    args = parser.parse_args()
+
+    core = XRayCore(executable_path=XRAY_EXECUTABLE_PATH, assets_path=WORK_PATH)
+    # the core runs xray with only it's own environment
+    core._env.update({
+        "FAKE_XRAY_START_DELAY": "0",
+        "FAKE_XRAY_LINES": str(args.lines),
+        "FAKE_XRAY_RATE": str(args.rate),
+        "FAKE_XRAY_STDERR_EVERY": "10"
+    })
+
+    config = XRayConfig(make_config_json(), '127.0.0.1')
+    start, cpu_start = time.perf_counter(), time.process_time()
+    core.start(config)
+    try:
+        target = args.lines + STARTUP_LINES
+        while core.logs.next_seq < target:
+            if not core.started:
+                raise SystemExit("Fake xray exited before writing every line")
+            time.sleep(0.001)
+        elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+    finally:
+        core.stop()
+
+    print(f"{args.lines} lines in {elapsed:.2f}s: {args.lines / elapsed:,.0f} lines/s, "
+          f"{cpu / args.lines * 1e6:.2f} CPU seconds per million lines")
+
+
+if __name__ == '__main__':
+    main()
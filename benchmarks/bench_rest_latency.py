@@ -0,0 +1,89 @@
+"""
+REST control plane: latency percentiles of /ping while other clients keep restarting the core,
+the restarts alternate between two configs so every one of them takes the restart strategy
+serves the app with uvicorn over plain HTTP, the fake xray gets ready 0.1 s after it's spawned
+
+    python benchmarks/bench_rest_latency.py [--restarters N] [--duration SECONDS]
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+
+from common import make_config, percentiles
+
+import uvicorn
+
+import rest_service
+
+PORT = 62150
+
+
+def post(connection: http.client.HTTPConnection, path: str, body: dict) -> dict:
+    connection.request('POST', path, json.dumps(body), {"Content-Type": "application/json"})
+    response = connection.getresponse()
+    data = response.read()
+    if response.status != 200:
+        raise RuntimeError(f"{path} failed with {response.status}: {data.decode()}")
+    return json.loads(data)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--restarters', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=8)
+    args = parser.parse_args()
+
+    configs = []
+    for i in range(2):
+        config = make_config(100)
+        config['outbounds'].append({"protocol": "blackhole", "tag": f"BLOCK{i}"})
+        configs.append(json.dumps(config))
+
+    server = uvicorn.Server(uvicorn.Config(rest_service.app, port=PORT, log_level='error'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    control = http.client.HTTPConnection('127.0.0.1', PORT, timeout=60)
+    session_id = post(control, '/connect', {})['session_id']
+    post(control, '/start', {"session_id": session_id, "config": configs[0]})
+    control.close()
+
+    stopping = threading.Event()
+    restarts = []
+
+    def restart_loop():
+        connection = http.client.HTTPConnection('127.0.0.1', PORT, timeout=60)
+        n = 0
+        while not stopping.is_set():
+            n += 1
+            post(connection, '/restart', {"session_id": session_id, "config": configs[n % 2]})
+            restarts.append(n)
+
+    restarters = [threading.Thread(target=restart_loop) for _ in range(args.restarters)]
+    for thread in restarters:
+        thread.start()
+
+    latencies = []
+    connection = http.client.HTTPConnection('127.0.0.1', PORT, timeout=60)
+    end = time.monotonic() + args.duration
+    while time.monotonic() < end:
+        start = time.perf_counter()
+        post(connection, '/ping', {"session_id": session_id})
+        latencies.append(time.perf_counter() - start)
+
+    stopping.set()
+    for thread in restarters:
+        thread.join()
+    post(http.client.HTTPConnection('127.0.0.1', PORT, timeout=60), '/stop', {"session_id": session_id})
+    server.should_exit = True
+
+    p50, p99 = percentiles(latencies, 50, 99)
+    print(f"{args.restarters} restarters, {len(restarts)} restarts, {len(latencies)} pings: "
+          f"p50 {p50 * 1000:.1f}ms p99 {p99 * 1000:.1f}ms max {max(latencies) * 1000:.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
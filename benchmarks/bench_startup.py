@@ -0,0 +1,54 @@
+"""
+Node startup: time from launching main.py until it's port accepts connections, for every protocol,
+the certificate already exists so it's generation isn't counted (see bench_certificates.py for that)
+
+    python benchmarks/bench_startup.py [--runs N] [protocol ...]
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from common import ROOT_PATH, percentiles
+
+PORT = 62160
+PROTOCOLS = ('rest', 'rpyc', 'websocket')
+
+
+def time_to_listening(protocol: str, timeout: float = 30) -> float:
+    env = dict(os.environ, SERVICE_PROTOCOL=protocol, SERVICE_PORT=str(PORT))
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'main.py'], cwd=ROOT_PATH, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', PORT), timeout=0.05).close()
+                return time.perf_counter() - start
+            except OSError:
+                if process.poll() is not None:
+                    raise RuntimeError(f"main.py exited with code {process.returncode} before listening")
+                if time.perf_counter() - start > timeout:
+                    raise TimeoutError(f"main.py didn't listen within {timeout} seconds")
+                time.sleep(0.005)
+    finally:
+        process.kill()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('protocols', nargs='*', default=PROTOCOLS)
+    args = parser.parse_args()
+
+    for protocol in args.protocols:
+        durations = [time_to_listening(protocol) for _ in range(args.runs)]
+        median, = percentiles(durations, 50)
+        print(f"{protocol:10} median {median * 1000:.0f}ms min {min(durations) * 1000:.0f}ms ({args.runs} runs)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Traffic history store: memory per thousand users (the rings' own size and what tracemalloc sees allocated),
+the cost of a sample adding deltas of every user, of moving into a new bucket and of querying an hour of users
+
+    python benchmarks/bench_stats_store.py [users ...]
+"""
+import sys
+import time
+import tracemalloc
+
+import common  # noqa: F401
+
+from timeseries import TimeSeriesStore
+
+
+def deltas(users: int, value: int) -> dict:
+    result = {}
+    for i in range(users):
+        result[f'user>>>user{i}>>>traffic>>>uplink'] = value
+        result[f'user>>>user{i}>>>traffic>>>downlink'] = value * 4
+    return result
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000]
+    print(f"{'users':>6} {'rings/1k':>9} {'traced/1k':>10} {'sample':>8} {'new bucket':>11} {'query 100':>10}")
+    for users in sizes:
+        sample = deltas(users, 1024)
+        now = time.time()
+
+        tracemalloc.start()
+        store = TimeSeriesStore()
+        store.add(now, sample)
+        traced = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        # best of 3 of each
+        sampled = advanced = queried = float('inf')
+        keys = [f'user{i}' for i in range(100)]
+        for _ in range(3):
+            start = time.perf_counter()
+            store.add(now, sample)
+            sampled = min(sampled, time.perf_counter() - start)
+
+            # 10 s later every ring moves into a new bucket and clears it
+            start = time.perf_counter()
+            store.add(now + 10, sample)
+            advanced = min(advanced, time.perf_counter() - start)
+            now += 10
+
+            start = time.perf_counter()
+            store.query('user', keys, now - 3600, now)
+            queried = min(queried, time.perf_counter() - start)
+
+        print(f"{users:>6} {store.memory_usage / users * 1000 / 2 ** 20:>7.1f}Mi "
+              f"{traced / users * 1000 / 2 ** 20:>8.1f}Mi {sampled * 1000:>6.1f}ms "
+              f"{advanced * 1000:>9.1f}ms {queried * 1000:>8.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
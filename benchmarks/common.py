@@ -0,0 +1,66 @@
+"""
+Shared setup of the benchmarks, import it before any of the node's modules
+points the node at the fake xray executable, a throwaway assets directory and a certificate generated for the run,
+an XRAY_EXECUTABLE_PATH already in the environment is kept so a benchmark can be pointed at a real xray binary
+"""
+import json
+import os
+import sys
+import tempfile
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+ROOT_PATH = os.path.dirname(BENCHMARKS_PATH)
+sys.path.insert(0, ROOT_PATH)
+
+from certificate import generate_certificate, write_atomic  # noqa: E402
+
+FAKE_XRAY_PATH = os.path.join(BENCHMARKS_PATH, 'fake_xray.py')
+WORK_PATH = tempfile.mkdtemp(prefix='marzban-node-benchmarks-')
+CERT_FILE = os.path.join(WORK_PATH, 'ssl_cert.pem')
+KEY_FILE = os.path.join(WORK_PATH, 'ssl_key.pem')
+
+pems = generate_certificate('ecdsa-p256')
+write_atomic(KEY_FILE, pems['key'], 0o600)
+write_atomic(CERT_FILE, pems['cert'])
+
+os.environ.setdefault("XRAY_EXECUTABLE_PATH", FAKE_XRAY_PATH)
+# SSL_CERT_FILE is often set for OpenSSL itself already, so these are always overridden
+os.environ.update({
+    "XRAY_ASSETS_PATH": WORK_PATH,
+    "XRAY_API_PORT": "62151",
+    "SSL_CERT_FILE": CERT_FILE,
+    "SSL_KEY_FILE": KEY_FILE,
+    "SSL_CLIENT_CERT_FILE": CERT_FILE,
+})
+
+
+def make_config(clients: int = 1, inbounds: int = 1) -> dict:
+    """Returns a config of VLESS inbounds tagged inbound0, inbound1, ... sharing the clients between them"""
+    return {
+        "log": {"loglevel": "warning"},
+        "inbounds": [
+            {
+                "tag": f"inbound{i}",
+                "protocol": "vless",
+                "port": 2000 + i,
+                "settings": {
+                    "decryption": "none",
+                    "clients": [
+                        {"id": f"{n:032x}", "email": f"user{n}", "flow": "xtls-rprx-vision"}
+                        for n in range(i, clients, inbounds)
+                    ]
+                }
+            }
+            for i in range(inbounds)
+        ],
+        "outbounds": [{"protocol": "freedom", "tag": "DIRECT"}]
+    }
+
+
+def make_config_json(clients: int = 1, inbounds: int = 1) -> str:
+    return json.dumps(make_config(clients, inbounds))
+
+
+def percentiles(samples: list, *points) -> list:
+    samples = sorted(samples)
+    return [samples[min(len(samples) - 1, int(len(samples) * p / 100))] for p in points]
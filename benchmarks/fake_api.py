@@ -0,0 +1,86 @@
+"""
+A local stand-in for Xray's gRPC API (HandlerService/AlterInbound and RemoveInbound, StatsService/QueryStats),
+errors are reported with the same messages Xray uses so the node's error mapping can be exercised
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+
+from xray_api import _bytes_field, _int_field, _parse_message, _string_field
+
+
+class FakeXrayAPI(object):
+    def __init__(self, inbounds: dict = None):
+        # inbound tag -> emails of the users in it
+        self.inbounds = {tag: set(emails) for tag, emails in (inbounds or {}).items()}
+        self.stats = {}
+        self.calls = []
+        self.server = None
+
+    def _alter_inbound(self, request: bytes, context: grpc.ServicerContext) -> bytes:
+        fields = dict(_parse_message(request))
+        tag = fields[1].decode()
+        operation = dict(_parse_message(fields[2]))
+        type_name, message = operation[1].decode(), dict(_parse_message(operation[2]))
+
+        users = self.inbounds.get(tag)
+        if users is None:
+            context.abort(grpc.StatusCode.UNKNOWN, f"app/proxyman/command: handler not found: {tag}")
+
+        if type_name.endswith('AddUserOperation'):
+            email = dict(_parse_message(message[1]))[2].decode()
+            if email in users:
+                context.abort(grpc.StatusCode.UNKNOWN, f"app/proxyman/command: failed to add user > "
+                                                       f"proxy/vless: User {email} already exists.")
+            users.add(email)
+        else:
+            email = message[1].decode()
+            if email not in users:
+                context.abort(grpc.StatusCode.UNKNOWN, f"app/proxyman/command: failed to remove user > "
+                                                       f"proxy/vless: User {email} not found.")
+            users.discard(email)
+
+        self.calls.append((tag, type_name.rsplit('.', 1)[-1], email))
+        return b''
+
+    def _remove_inbound(self, request: bytes, context: grpc.ServicerContext) -> bytes:
+        tag = dict(_parse_message(request)).get(1, b'').decode()
+        self.calls.append((tag, 'RemoveInbound', None))
+        return b''
+
+    def _query_stats(self, request: bytes, context: grpc.ServicerContext) -> bytes:
+        fields = dict(_parse_message(request))
+        pattern, reset = fields.get(1, b'').decode(), fields.get(2, 0)
+
+        stats = []
+        for name, value in list(self.stats.items()):
+            if pattern in name:
+                stats.append(_bytes_field(1, _string_field(1, name) + _int_field(2, value)))
+                if reset:
+                    self.stats[name] = 0
+        return b''.join(stats)
+
+    def start(self, port: int, cert_file: str, key_file: str):
+        with open(cert_file, 'rb') as f:
+            cert = f.read()
+        with open(key_file, 'rb') as f:
+            key = f.read()
+
+        self.server = grpc.server(ThreadPoolExecutor(max_workers=4))
+        self.server.add_generic_rpc_handlers((
+            grpc.method_handlers_generic_handler('xray.app.proxyman.command.HandlerService', {
+                'AlterInbound': grpc.unary_unary_rpc_method_handler(self._alter_inbound),
+                'RemoveInbound': grpc.unary_unary_rpc_method_handler(self._remove_inbound)
+            }),
+            grpc.method_handlers_generic_handler('xray.app.stats.command.StatsService', {
+                'QueryStats': grpc.unary_unary_rpc_method_handler(self._query_stats)
+            })
+        ))
+        self.server.add_secure_port(f'127.0.0.1:{port}', grpc.ssl_server_credentials([(key, cert)]))
+        self.server.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop(0)
+        self.server = None
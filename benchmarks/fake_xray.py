@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Stands in for the xray executable so the node can be benchmarked without a real core
+version: prints a version line like `xray version` does
+run -test: validates the config from stdin, configs with a "fakeReject" key fail
+run: reads the config from stdin, gets ready after FAKE_XRAY_START_DELAY seconds, then writes access log lines,
+FAKE_XRAY_RATE lines per second or as fast as it can when it's 0, FAKE_XRAY_LINES in total (0 for no end)
+and every FAKE_XRAY_STDERR_EVERY'th line to stderr, then idles until it's killed
+"""
+import json
+import os
+import sys
+import time
+
+VERSION = "1.8.24"
+BATCH_SIZE = 1000
+
+
+def access_line(i: int) -> bytes:
+    return (f"2024/01/01 00:00:01 from 10.0.{i % 250}.{i % 200}:5555 accepted tcp:example{i % 7}.com:443 "
+            f"[inbound{i % 3} >> DIRECT] email: user{i % 1000}\n").encode()
+
+
+def run():
+    config = json.loads(sys.stdin.read())
+    if "fakeReject" in config:
+        print("Failed to start: main: failed to load config files: rejected by fake xray", flush=True)
+        sys.exit(23)
+
+    out = sys.stdout.buffer
+    out.write(f"Xray {VERSION} (Xray, Penetrates Everything.) Custom (go1.22 linux/amd64)\n".encode())
+    out.flush()
+    time.sleep(float(os.environ.get('FAKE_XRAY_START_DELAY', '0.1')))
+    out.write(f"2024/01/01 00:00:00 [Warning] core: Xray {VERSION} started\n".encode())
+    out.flush()
+
+    rate = float(os.environ.get('FAKE_XRAY_RATE', '0'))
+    total = int(os.environ.get('FAKE_XRAY_LINES', '0'))
+    stderr_every = int(os.environ.get('FAKE_XRAY_STDERR_EVERY', '0'))
+    # lines are written in batches, small ones when a rate is set so it's followed closely
+    batch = BATCH_SIZE if not rate else max(1, min(BATCH_SIZE, int(rate / 100)))
+
+    i = 0
+    started = time.monotonic()
+    while not total or i < total:
+        n = min(batch, total - i) if total else batch
+        lines = [access_line(i + j) for j in range(n)]
+        if stderr_every:
+            errors = [line for j, line in enumerate(lines) if (i + j) % stderr_every == 0]
+            lines = [line for j, line in enumerate(lines) if (i + j) % stderr_every != 0]
+            sys.stderr.buffer.write(b''.join(errors))
+            sys.stderr.buffer.flush()
+        out.write(b''.join(lines))
+        out.flush()
+        i += n
+        if rate:
+            delay = started + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['version']:
+        print(f"Xray {VERSION} (Xray, Penetrates Everything.) Custom (go1.22 linux/amd64)")
+    elif sys.argv[1:2] == ['run'] and '-test' in sys.argv:
+        config = json.loads(sys.stdin.read())
+        if "fakeReject" in config:
+            print("Failed to start: main: failed to load config files: rejected by fake xray")
+            sys.exit(23)
+        print("Configuration OK.")
+    elif sys.argv[1:2] == ['run']:
+        run()
+    else:
+        sys.exit(f"Unsupported arguments: {' '.join(sys.argv[1:])}")
@@ -1,20 +1,63 @@
-from OpenSSL import crypto
-
-
-def generate_certificate():
-    k = crypto.PKey()
-    k.generate_key(crypto.TYPE_RSA, 4096)
-    cert = crypto.X509()
-    cert.get_subject().CN = "Gozargah"
-    cert.gmtime_adj_notBefore(0)
-    cert.gmtime_adj_notAfter(100*365*24*60*60)
-    cert.set_issuer(cert.get_subject())
-    cert.set_pubkey(k)
-    cert.sign(k, 'sha512')
-    cert_pem = crypto.dump_certificate(crypto.FILETYPE_PEM, cert).decode("utf-8")
-    key_pem = crypto.dump_privatekey(crypto.FILETYPE_PEM, k).decode("utf-8")
+import datetime
+import os
+import tempfile
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import NameOID
+
+# ed25519 isn't offered, the node's own gRPC client to the Xray API (BoringSSL) rejects ed25519 certificates
+KEY_TYPES = ('rsa-2048', 'rsa-3072', 'rsa-4096', 'ecdsa-p256')
+
+
+def generate_key(key_type: str = 'rsa-4096'):
+    if key_type.startswith('rsa-') and key_type in KEY_TYPES:
+        return rsa.generate_private_key(public_exponent=65537, key_size=int(key_type[4:]))
+    if key_type == 'ecdsa-p256':
+        return ec.generate_private_key(ec.SECP256R1())
+    raise ValueError(f'Invalid key type "{key_type}", must be one of {", ".join(KEY_TYPES)}')
+
+
+def generate_certificate(key_type: str = 'rsa-4096'):
+    k = generate_key(key_type)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "Gozargah")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder() \
+        .subject_name(name) \
+        .issuer_name(name) \
+        .public_key(k.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now) \
+        .not_valid_after(now + datetime.timedelta(days=100 * 365)) \
+        .sign(k, hashes.SHA512())
+
+    cert_pem = cert.public_bytes(serialization.Encoding.PEM).decode("utf-8")
+    key_pem = k.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    ).decode("utf-8")
 
     return {
         "cert": cert_pem,
         "key": key_pem
     }
+
+
+def write_atomic(path: str, data: str, mode: int = 0o644):
+    """Writes to a temporary file next to path and renames it over path, so path is never half-written"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
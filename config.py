@@ -10,11 +10,35 @@ XRAY_API_HOST = config("XRAY_API_HOST", default="0.0.0.0")
 XRAY_API_PORT = config('XRAY_API_PORT', cast=int, default=62051)
 XRAY_EXECUTABLE_PATH = config("XRAY_EXECUTABLE_PATH", default="/usr/local/bin/xray")
 XRAY_ASSETS_PATH = config("XRAY_ASSETS_PATH", default="/usr/local/share/xray")
+XRAY_START_TIMEOUT = config("XRAY_START_TIMEOUT", cast=float, default=10)
+XRAY_RESTART_MODE = config("XRAY_RESTART_MODE", default="stop-start")
+XRAY_DRAIN_TIMEOUT = config("XRAY_DRAIN_TIMEOUT", cast=float, default=5)
+XRAY_STOP_TIMEOUT = config("XRAY_STOP_TIMEOUT", cast=float, default=5)
+XRAY_AUTO_RECOVER = config("XRAY_AUTO_RECOVER", cast=bool, default=True)
+XRAY_RECOVERY_BACKOFF = config("XRAY_RECOVERY_BACKOFF", cast=float, default=1)
+XRAY_RECOVERY_BACKOFF_MAX = config("XRAY_RECOVERY_BACKOFF_MAX", cast=float, default=60)
+XRAY_VALIDATE_CONFIG = config("XRAY_VALIDATE_CONFIG", cast=bool, default=True)
+XRAY_VALIDATION_TIMEOUT = config("XRAY_VALIDATION_TIMEOUT", cast=float, default=10)
+XRAY_VALIDATION_WORKERS = config("XRAY_VALIDATION_WORKERS", cast=int, default=2)
+XRAY_HOOK_WORKERS = config("XRAY_HOOK_WORKERS", cast=int, default=2)
+
+ACCESS_LOG_AGGREGATION = config("ACCESS_LOG_AGGREGATION", cast=bool, default=False)
+LOG_BUFFER_SIZE = config("LOG_BUFFER_SIZE", cast=int, default=1024 * 1024)
+LOG_SPOOL_PATH = config("LOG_SPOOL_PATH", default="")
+LOG_SPOOL_SEGMENT_SIZE = config("LOG_SPOOL_SEGMENT_SIZE", cast=int, default=16 * 1024 * 1024)
+LOG_SPOOL_MAX_SIZE = config("LOG_SPOOL_MAX_SIZE", cast=int, default=256 * 1024 * 1024)
+LOG_SPOOL_MAX_AGE = config("LOG_SPOOL_MAX_AGE", cast=float, default=7 * 24 * 3600)
+STATS_SAMPLE_INTERVAL = config("STATS_SAMPLE_INTERVAL", cast=int, default=0)
+ENFORCEMENT_INTERVAL = config("ENFORCEMENT_INTERVAL", cast=float, default=10)
 
 SSL_CERT_FILE = config("SSL_CERT_FILE", default="/var/lib/marzban-node/ssl_cert.pem")
 SSL_KEY_FILE = config("SSL_KEY_FILE", default="/var/lib/marzban-node/ssl_key.pem")
 SSL_CLIENT_CERT_FILE = config("SSL_CLIENT_CERT_FILE", default="")
+SSL_KEY_TYPE = config("SSL_KEY_TYPE", default="rsa-4096")
 
 DEBUG = config("DEBUG", cast=bool, default=False)
 
 SERVICE_PROTOCOL = config('SERVICE_PROTOCOL', cast=str, default='rest')
+RPYC_POOL_SIZE = config('RPYC_POOL_SIZE', cast=int, default=20)
+RPYC_HANDSHAKE_TIMEOUT = config('RPYC_HANDSHAKE_TIMEOUT', cast=float, default=10)
+WS_HEARTBEAT_INTERVAL = config('WS_HEARTBEAT_INTERVAL', cast=float, default=10)
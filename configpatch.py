@@ -0,0 +1,107 @@
+import copy
+
+
+class PatchError(ValueError):
+    pass
+
+
+def _parse_pointer(pointer: str) -> list:
+    if not isinstance(pointer, str) or (pointer and not pointer.startswith('/')):
+        raise PatchError(f'Invalid JSON pointer "{pointer}"')
+    if not pointer:
+        return []
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+
+def _index(container: list, token: str, allow_end: bool = False) -> int:
+    if token == '-' and allow_end:
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token[0] == '0'):
+        raise PatchError(f'Invalid array index "{token}"')
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise PatchError(f'Array index {index} is out of range')
+    return index
+
+
+def _walk(doc, tokens: list):
+    for token in tokens:
+        if isinstance(doc, dict):
+            if token not in doc:
+                raise PatchError(f'Path member "{token}" not found')
+            doc = doc[token]
+        elif isinstance(doc, list):
+            doc = doc[_index(doc, token)]
+        else:
+            raise PatchError(f'Can not traverse into "{token}"')
+    return doc
+
+
+def _add(doc, tokens: list, value):
+    if not tokens:
+        return value
+    parent = _walk(doc, tokens[:-1])
+    if isinstance(parent, dict):
+        parent[tokens[-1]] = value
+    elif isinstance(parent, list):
+        parent.insert(_index(parent, tokens[-1], allow_end=True), value)
+    else:
+        raise PatchError(f'Can not add "{tokens[-1]}" to a scalar')
+    return doc
+
+
+def _remove(doc, tokens: list):
+    if not tokens:
+        raise PatchError("Can not remove the whole document")
+    parent = _walk(doc, tokens[:-1])
+    if isinstance(parent, dict):
+        if tokens[-1] not in parent:
+            raise PatchError(f'Path member "{tokens[-1]}" not found')
+        return parent.pop(tokens[-1])
+    if isinstance(parent, list):
+        return parent.pop(_index(parent, tokens[-1]))
+    raise PatchError(f'Can not remove "{tokens[-1]}" from a scalar')
+
+
+def apply_patch(doc, patch: list):
+    """
+    Applies a JSON patch (RFC 6902) to doc in place and returns the result,
+    which is a different object only if the whole document was replaced
+    raises PatchError if an operation fails or a test doesn't match
+    """
+    if not isinstance(patch, list):
+        raise PatchError("Patch must be a list of operations")
+
+    for operation in patch:
+        try:
+            op = operation['op']
+            path = _parse_pointer(operation['path'])
+            if op in ('add', 'replace', 'test'):
+                value = operation['value']
+            elif op in ('move', 'copy'):
+                source = _parse_pointer(operation['from'])
+        except (KeyError, TypeError) as exc:
+            raise PatchError(f'Invalid operation {operation}: missing {exc}')
+
+        if op == 'add':
+            doc = _add(doc, path, value)
+        elif op == 'remove':
+            _remove(doc, path)
+        elif op == 'replace':
+            _walk(doc, path)
+            if path:
+                _remove(doc, path)
+            doc = _add(doc, path, value)
+        elif op == 'move':
+            if path[:len(source)] == source and path != source:
+                raise PatchError("Can not move a value into one of it's children")
+            doc = _add(doc, path, _remove(doc, source))
+        elif op == 'copy':
+            doc = _add(doc, path, copy.deepcopy(_walk(doc, source)))
+        elif op == 'test':
+            if _walk(doc, path) != value:
+                raise PatchError(f'Test failed at "{operation["path"]}"')
+        else:
+            raise PatchError(f'Unknown operation "{op}"')
+
+    return doc
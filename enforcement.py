@@ -0,0 +1,199 @@
+import threading
+import time
+from collections import deque
+
+from logger import logger
+from xray_api import XRayAPIError
+
+LIMIT_KEYS = {'data_limit', 'ip_limit', 'expire'}
+
+
+class Enforcer(object):
+    """
+    Enforces per-user limits pushed by the panel on the node itself
+    data_limit: bytes the user may still use since the limit was pushed, counters are read without reset
+    so a panel polling Xray's stats with reset keeps owning them, traffic between the enforcer's last read
+    and such a reset (at most an interval's worth) isn't counted
+    ip_limit: max distinct source IPs seen within the online window (needs access log aggregation)
+    expire: unix timestamp after which the user gets removed
+    violating users are removed from every inbound through the API and an event is queued for the panel
+    """
+
+    def __init__(self, core=None, interval: float = 10, max_events: int = 10000):
+        self.core = core
+        self.interval = interval
+        self.limits = {}
+        self.events = deque(maxlen=max_events)
+        self.last_event_id = 0
+
+        # bytes counted for each user since it's limit was pushed, and the last reading of every counter
+        self._usage = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @staticmethod
+    def _counter_names(email: str) -> tuple:
+        return f'user>>>{email}>>>traffic>>>uplink', f'user>>>{email}>>>traffic>>>downlink'
+
+    @staticmethod
+    def _read(core) -> dict:
+        if core is None or not core.started:
+            return {}
+        return core.stats.peek('user>>>')
+
+    def attach(self, core):
+        """
+        Moves enforcement to a new core, the limits, usage and events are kept,
+        a new core's counters start from zero so all of their traffic counts
+        """
+        with self._lock:
+            if self.core is not None and self.core is not core:
+                self._counters = dict.fromkeys(self._counters, 0)
+            self.core = core
+
+    def set_limits(self, limits: dict, replace: bool = False):
+        # every limit is checked before any is applied, so a bad one leaves the current limits as they are
+        for email, limit in limits.items():
+            if not limit:
+                continue
+            if not isinstance(limit, dict) or set(limit) - LIMIT_KEYS:
+                raise ValueError(f'Invalid limit of "{email}", keys must be some of {", ".join(sorted(LIMIT_KEYS))}')
+            for key, value in limit.items():
+                # bool is an int too, but never a meaningful limit
+                if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+                    raise ValueError(f'Invalid {key} of "{email}", must be a non-negative number')
+
+        try:
+            readings = self._read(self.core)
+        except (XRayAPIError, RuntimeError):
+            readings = {}
+
+        with self._lock:
+            if replace:
+                self.limits = {}
+                self._usage = {}
+                self._counters = {}
+            for email, limit in limits.items():
+                names = self._counter_names(email)
+                for name in names:
+                    self._counters.pop(name, None)
+                if not limit:
+                    self.limits.pop(email, None)
+                    self._usage.pop(email, None)
+                    continue
+                self.limits[email] = limit
+                self._usage[email] = 0
+                # counted from now on, users without a reading yet are counted from the next one
+                for name in names:
+                    if name in readings:
+                        self._counters[name] = readings[name]
+
+        self.start()
+
+    def start(self):
+        """Starts the check loop unless it's running already, the core calls it whenever it starts"""
+        with self._lock:
+            if self._thread is not None or not self.limits or self.interval <= 0:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        # the loop ends once there's nothing left to enforce or the core is stopped, start() brings it back
+        try:
+            while True:
+                time.sleep(self.interval)
+                with self._lock:
+                    core = self.core
+                    if not self.limits or core is None or not core.started:
+                        self._thread = None
+                        return
+                try:
+                    self.check()
+                except (XRayAPIError, RuntimeError) as exc:
+                    logger.debug(f"Enforcement check failed: {exc}")
+                except Exception:
+                    # a single bad iteration must not end enforcement for good
+                    logger.exception("Enforcement check failed")
+        finally:
+            with self._lock:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+
+    def _count(self, core):
+        """Adds what the counters of users with a data limit went up by since the last reading to their usage"""
+        readings = self._read(core)
+        with self._lock:
+            for email, limit in self.limits.items():
+                if limit.get('data_limit') is None:
+                    continue
+                for name in self._counter_names(email):
+                    current = readings.get(name, 0)
+                    previous = self._counters.get(name)
+                    self._counters[name] = current
+                    if previous is not None:
+                        # a counter lower than before was reset, by the panel or a new core, since the last reading
+                        self._usage[email] = self._usage.get(email, 0) + (
+                            current - previous if current >= previous else current)
+
+    def check(self):
+        now = time.time()
+        core = self.core
+        access = core.access
+        online_window = access.online_window if access is not None else None
+        seen_users = access.users if access is not None else {}
+
+        self._count(core)
+
+        violations = {}
+        with self._lock:
+            for email, limit in self.limits.items():
+                expire = limit.get('expire')
+                if expire and expire <= now:
+                    violations[email] = "expired"
+                    continue
+
+                data_limit = limit.get('data_limit')
+                if data_limit is not None:
+                    if self._usage.get(email, 0) >= data_limit:
+                        violations[email] = "data_limit"
+                        continue
+
+                ip_limit = limit.get('ip_limit')
+                # only users with recent access logs can be over the limit, skip the locked lookup for the rest
+                if ip_limit and email in seen_users and len(access.user_ips(email, online_window)) > ip_limit:
+                    violations[email] = "ip_limit"
+
+        if violations:
+            self._enforce(core, violations, now)
+
+    def _enforce(self, core, violations: dict, now: float):
+        inbounds, result = core.remove_users(violations)
+        failed = {error.get('email') for error in result["errors"]}
+
+        with self._lock:
+            for email, reason in violations.items():
+                if email in failed:
+                    continue
+                self.limits.pop(email, None)
+                self._usage.pop(email, None)
+                for name in self._counter_names(email):
+                    self._counters.pop(name, None)
+                self.last_event_id += 1
+                self.events.append({
+                    "id": self.last_event_id,
+                    "email": email,
+                    "reason": reason,
+                    "inbounds": inbounds.get(email, []),
+                    "timestamp": round(now)
+                })
+                logger.info(f'User "{email}" removed from the core, reason: {reason}')
+
+    def get_events(self, after: int = 0, limit: int = 1000) -> dict:
+        with self._lock:
+            events = [event for event in self.events if event["id"] > after][:limit]
+        return {
+            "last_event_id": self.last_event_id,
+            "events": events
+        }
@@ -0,0 +1,198 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+
+
+class LogSubscriber(object):
+    """
+    Reads lines from the shared buffer of a LogBus by sequence number,
+    subscribers keep nothing but a cursor so memory doesn't grow with their count
+    """
+
+    def __init__(self, bus: "LogBus", cursor: int, missed: int = 0, log_filter: callable = None):
+        self.bus = bus
+        self.filter = log_filter
+        self.cursor = cursor
+        self.delivered = 0
+        self.dropped = 0
+        self._missed = missed
+        self._waiter = None
+        # called from the publishing thread with the bus locked whenever lines arrive, must be quick
+        self.listener = None
+
+    def __bool__(self):
+        return self.cursor < self.bus.next_seq or self._missed > 0
+
+    def __len__(self):
+        return self.lag
+
+    @property
+    def lag(self):
+        return max(self.bus.next_seq - self.cursor, 0)
+
+    def read(self, limit: int = None):
+        """
+        Returns (seq, lines, missed) where seq is the sequence number of the first line read
+        and missed is the number of lines evicted from the buffer before this subscriber could read them,
+        lines are passed through the subscriber's filter so the cursor may move further than len(lines)
+        """
+        seq, lines, evicted = self.bus.read(self.cursor, limit)
+        missed, self._missed = self._missed + evicted, 0
+
+        self.dropped += evicted
+        self.cursor = seq + len(lines)
+        if self.filter is not None:
+            lines = self.filter(lines)
+        self.delivered += len(lines)
+        return seq, lines, missed
+
+    def popleft(self):
+        _, lines, _ = self.read(1)
+        if not lines:
+            raise IndexError("pop from an empty subscriber")
+        return lines[0]
+
+    def drain(self) -> list:
+        return self.read()[1]
+
+    def notify(self):
+        if self.listener is not None:
+            self.listener()
+
+        waiter = self._waiter
+        if waiter is not None:
+            loop, event = waiter
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:  # event loop is closed
+                self._waiter = None
+
+    def wait(self, timeout: float = None) -> bool:
+        """Blocks the calling thread until new lines arrive or timeout expires"""
+        with self.bus.condition:
+            return self.bus.condition.wait_for(self.__bool__, timeout)
+
+    async def wait_async(self, timeout: float = None) -> bool:
+        """Same as wait() but suspends the running coroutine instead of a thread"""
+        if self:
+            return True
+
+        loop = asyncio.get_running_loop()
+        if self._waiter is None or self._waiter[0] is not loop:
+            self._waiter = (loop, asyncio.Event())
+        event = self._waiter[1]
+        event.clear()
+
+        # lines may have been published between the first check and clear()
+        if self:
+            return True
+
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def stats(self):
+        stats = {
+            "cursor": self.cursor,
+            "lag": self.lag,
+            "delivered": self.delivered,
+            "dropped": self.dropped
+        }
+        if self.filter is not None:
+            stats.update(self.filter.stats())
+        return stats
+
+
+class LogBus(object):
+    """
+    Keeps captured log lines in a shared ring buffer bounded by max_bytes (total length of the lines),
+    every line gets a monotonically increasing sequence number subscribers read from and resume by
+    """
+
+    def __init__(self, backlog: int = 100, max_bytes: int = 1024 * 1024):
+        self.backlog = backlog
+        self.max_bytes = max_bytes
+        self.condition = threading.Condition()
+
+        self.first_seq = 0
+        self.next_seq = 0
+        self.size = 0
+
+        self._lines = []
+        self._start = 0
+        self._subscribers = set()
+
+    @property
+    def last_line(self):
+        with self.condition:
+            if self.next_seq > self.first_seq:
+                return self._lines[-1]
+
+    def publish(self, lines: list):
+        if not lines:
+            return
+
+        with self.condition:
+            self._lines.extend(lines)
+            self.next_seq += len(lines)
+            self.size += sum(map(len, lines))
+
+            while self.size > self.max_bytes and self.first_seq < self.next_seq - 1:
+                self.size -= len(self._lines[self._start])
+                self._lines[self._start] = None
+                self._start += 1
+                self.first_seq += 1
+
+            # compact once half of the list is evicted lines
+            if self._start > len(self._lines) // 2:
+                del self._lines[:self._start]
+                self._start = 0
+
+            for subscriber in self._subscribers:
+                subscriber.notify()
+            self.condition.notify_all()
+
+    def read(self, seq: int, limit: int = None):
+        """Returns (seq, lines, evicted) starting at seq or the oldest line still in the buffer"""
+        with self.condition:
+            evicted = 0
+            if seq < self.first_seq:
+                evicted = self.first_seq - seq
+                seq = self.first_seq
+            seq = min(seq, self.next_seq)
+
+            start = self._start + seq - self.first_seq
+            end = self._start + self.next_seq - self.first_seq
+            if limit is not None:
+                end = min(end, start + limit)
+            return seq, self._lines[start:end], evicted
+
+    @contextmanager
+    def subscribe(self, since: int = None, log_filter: callable = None):
+        """
+        Subscribes from the since sequence number, or the last backlog lines if it's not given
+        lines already evicted since then are reported as missed on the first read
+        """
+        with self.condition:
+            missed = 0
+            if since is None:
+                cursor = max(self.next_seq - self.backlog, self.first_seq)
+            else:
+                cursor = min(max(since, 0), self.next_seq)
+                if cursor < self.first_seq:
+                    missed = self.first_seq - cursor
+                    cursor = self.first_seq
+
+            subscriber = LogSubscriber(self, cursor, missed, log_filter)
+            self._subscribers.add(subscriber)
+        try:
+            yield subscriber
+        finally:
+            with self.condition:
+                self._subscribers.discard(subscriber)
+
+    def stats(self) -> list:
+        with self.condition:
+            return [subscriber.stats() for subscriber in self._subscribers]
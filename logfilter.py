@@ -0,0 +1,107 @@
+import re
+import time
+
+LEVELS = {
+    "debug": 0,
+    "info": 1,
+    "warning": 2,
+    "error": 3
+}
+LEVEL_PATTERN = re.compile(r'\[(Debug|Info|Warning|Error)\]')
+
+
+class LogFilter(object):
+    """
+    Filters a subscriber's log lines, every given criterion must match:
+    level: minimum level, lines without a level tag (access logs) count as info
+    contains: any of the substrings, regex: a pattern searched in the line,
+    email/inbound: access log lines of a user or an inbound tag
+    then keeps sample ratio of the matching lines and at most max_rate lines per second
+    """
+
+    def __init__(self,
+                 level: str = None,
+                 contains: list = (),
+                 regex: str = None,
+                 email: str = None,
+                 inbound: str = None,
+                 sample: float = 1,
+                 max_rate: float = None):
+        if level is not None and level.lower() not in LEVELS:
+            raise ValueError(f'Invalid level "{level}", must be one of {", ".join(LEVELS)}')
+        if not 0 < sample <= 1:
+            raise ValueError("Sample ratio must be more than 0 and at most 1")
+        if max_rate is not None and max_rate <= 0:
+            raise ValueError("Max rate must be more than 0")
+
+        self.patterns = []
+        if contains:
+            self.patterns.append(re.compile('|'.join(map(re.escape, contains))))
+        if regex:
+            try:
+                self.patterns.append(re.compile(regex))
+            except re.error as exc:
+                raise ValueError(f'Invalid regex: {exc}')
+        if email:
+            self.patterns.append(re.compile(rf'email: {re.escape(email)}(\s|$)'))
+        if inbound:
+            self.patterns.append(re.compile(rf'\[{re.escape(inbound)} (>>|->) '))
+
+        self.min_level = LEVELS[level.lower()] if level else 0
+        self.sample = sample
+        self.max_rate = max_rate
+
+        self.matched = 0
+        self.sampled_out = 0
+        self.rate_limited = 0
+        self._reported = 0
+        self._credit = 0
+        self._tokens = max_rate or 0
+        self._last_refill = time.monotonic()
+
+    def _level(self, line: str) -> int:
+        m = LEVEL_PATTERN.search(line, 0, 64)
+        return LEVELS[m.group(1).lower()] if m else LEVELS["info"]
+
+    def __call__(self, lines: list) -> list:
+        if self.min_level:
+            lines = [line for line in lines if self._level(line) >= self.min_level]
+        for pattern in self.patterns:
+            search = pattern.search
+            lines = [line for line in lines if search(line)]
+        self.matched += len(lines)
+
+        if self.sample < 1:
+            kept = []
+            for line in lines:
+                self._credit += self.sample
+                if self._credit >= 1:
+                    self._credit -= 1
+                    kept.append(line)
+            self.sampled_out += len(lines) - len(kept)
+            lines = kept
+
+        if self.max_rate is not None and lines:
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._last_refill) * self.max_rate, self.max_rate)
+            self._last_refill = now
+
+            allowed = int(self._tokens)
+            if len(lines) > allowed:
+                self.rate_limited += len(lines) - allowed
+                lines = lines[:allowed]
+            self._tokens -= len(lines)
+
+        return lines
+
+    def take_rate_limited(self) -> int:
+        """Returns the number of lines dropped by max_rate since the last call"""
+        count, self._reported = self.rate_limited - self._reported, self.rate_limited
+        return count
+
+    def stats(self):
+        return {
+            "matched": self.matched,
+            "sampled_out": self.sampled_out,
+            "rate_limited": self.rate_limited
+        }
@@ -0,0 +1,341 @@
+import mmap
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+from logger import logger
+
+SEGMENT_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+EVICTION_INTERVAL = 60
+READ_BLOCK_SIZE = 256 * 1024
+
+
+class Segment(object):
+    """
+    A spool file of "<seq> <unix ms> <line>\\n" records starting at first_seq,
+    along with a sparse index of (seq, unix ms, offset) of a record every index_interval bytes
+    """
+
+    def __init__(self, directory: str, first_seq: int):
+        self.first_seq = first_seq
+        self.path = os.path.join(directory, f'{first_seq:020d}{SEGMENT_SUFFIX}')
+        self.index_path = os.path.join(directory, f'{first_seq:020d}{INDEX_SUFFIX}')
+
+        self.seqs = array('q')
+        self.times = array('q')
+        self.offsets = array('q')
+        self.size = 0
+        self.last_seq = first_seq - 1
+        self.last_time = 0
+
+    def add_index(self, seq: int, timestamp: int, offset: int):
+        self.seqs.append(seq)
+        self.times.append(timestamp)
+        self.offsets.append(offset)
+
+    def load(self, index_interval: int, truncate: bool = False):
+        """Loads the index and the last record, rebuilds the index if it's missing or doesn't match the file"""
+        self.size = os.path.getsize(self.path)
+        if self.size == 0:
+            return
+
+        with open(self.path, 'r+b' if truncate else 'rb') as f, \
+                mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ) as mm:
+            end = mm.rfind(b'\n') + 1
+            if end < self.size and truncate:
+                # the node was killed in the middle of a write, drop the partial record
+                logger.warning(f"Dropping a partial log record at the end of {self.path}")
+                f.truncate(end)
+            self.size = end
+
+            entries = array('q')
+            try:
+                with open(self.index_path, 'rb') as index:
+                    data = index.read()
+                entries.frombytes(data[:len(data) - len(data) % 24])
+            except OSError:
+                pass
+            if not entries or entries[0] != self.first_seq or entries[2] != 0:
+                entries = self._rebuild_index(mm, index_interval)
+
+            for i in range(0, len(entries), 3):
+                if entries[i + 2] >= self.size:
+                    break
+                self.add_index(*entries[i:i + 3])
+
+            if self.offsets:
+                for seq, timestamp, _ in iter_records(mm, self.offsets[-1], self.size):
+                    self.last_seq, self.last_time = seq, timestamp
+
+    def _rebuild_index(self, mm: mmap.mmap, index_interval: int) -> array:
+        entries = array('q')
+        next_indexed = 0
+        pos = 0
+        while pos < self.size:
+            end = mm.find(b'\n', pos, self.size)
+            if pos >= next_indexed:
+                try:
+                    seq, timestamp = parse_header(mm, pos, end)
+                except ValueError:
+                    pass
+                else:
+                    entries.extend((seq, timestamp, pos))
+                    next_indexed = pos + index_interval
+            pos = end + 1
+
+        with open(self.index_path, 'wb') as f:
+            f.write(entries.tobytes())
+        return entries
+
+
+def parse_header(mm: mmap.mmap, pos: int, end: int):
+    seq_end = mm.find(b' ', pos, end)
+    time_end = mm.find(b' ', seq_end + 1, end)
+    if seq_end == -1 or time_end == -1:
+        raise ValueError("Invalid log record")
+    return int(mm[pos:seq_end]), int(mm[seq_end + 1:time_end])
+
+
+def iter_records(mm: mmap.mmap, pos: int, size: int):
+    """
+    Yields (seq, unix ms, line) of the records in mm from pos to size,
+    records are decoded in blocks of whole lines so only a block is copied out of the map at a time,
+    blocks start small for short queries and double up to READ_BLOCK_SIZE
+    """
+    block_size = 4096
+    while pos < size:
+        end = mm.rfind(b'\n', pos, min(pos + block_size, size)) + 1
+        block_size = min(block_size * 2, READ_BLOCK_SIZE)
+        if not end:
+            # a single record longer than a block
+            end = mm.find(b'\n', pos, size) + 1
+            if not end:
+                return
+
+        for record in mm[pos:end].decode('utf-8', 'replace').split('\n')[:-1]:
+            try:
+                seq, timestamp, line = record.split(' ', 2)
+                yield int(seq), int(timestamp), line
+            except ValueError:
+                continue
+        pos = end
+
+
+class LogSpool(object):
+    """
+    Appends captured log lines to segment files in a directory so they outlive the in-memory buffer,
+    every line gets a sequence number that keeps increasing across node restarts, separate from the log bus' seqs
+    which start over with every core, the API calls it the history seq
+    a new segment is started once the current one reaches segment_size, the oldest ones are removed
+    while the spool is larger than max_size or their last line is older than max_age seconds
+    reads mmap the segments, only the sparse index and the lines returned are kept in memory
+    """
+
+    def __init__(self,
+                 path: str,
+                 segment_size: int = 16 * 1024 * 1024,
+                 max_size: int = 256 * 1024 * 1024,
+                 max_age: float = 7 * 24 * 3600,
+                 index_interval: int = 64 * 1024):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.max_age = max_age
+        self.index_interval = index_interval
+
+        self.segments = []
+        self.next_seq = 0
+
+        self._file = None
+        self._index_file = None
+        self._next_indexed = 0
+        self._last_eviction = 0
+        self._failing = False
+        self._lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        names = sorted(name for name in os.listdir(self.path) if name.endswith(SEGMENT_SUFFIX))
+        for i, name in enumerate(names):
+            try:
+                segment = Segment(self.path, int(name[:-len(SEGMENT_SUFFIX)]))
+                segment.load(self.index_interval, truncate=i == len(names) - 1)
+            except (ValueError, OSError) as exc:
+                logger.warning(f'Skipping log spool segment "{name}": {exc}')
+                continue
+            self.segments.append(segment)
+
+        if self.segments:
+            self.next_seq = self.segments[-1].last_seq + 1
+        self._evict(time.time())
+
+    @property
+    def size(self) -> int:
+        return sum(segment.size for segment in self.segments)
+
+    def _open(self, segment: Segment):
+        self._close()
+        self._file = open(segment.path, 'ab')
+        self._index_file = open(segment.index_path, 'ab')
+        self._next_indexed = segment.offsets[-1] + self.index_interval if segment.offsets else 0
+
+    def _close(self):
+        for f in (self._file, self._index_file):
+            if f is not None:
+                f.close()
+        self._file = self._index_file = None
+
+    def _active_segment(self) -> Segment:
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or segment.size >= self.segment_size:
+            segment = Segment(self.path, self.next_seq)
+            self.segments.append(segment)
+            self._open(segment)
+            self._evict(time.time())
+        elif self._file is None:
+            self._open(segment)
+        return segment
+
+    def _evict(self, now: float):
+        self._last_eviction = now
+        size = self.size
+        # the segment being written is never removed
+        while len(self.segments) > 1:
+            segment = self.segments[0]
+            if size <= self.max_size and (not self.max_age or segment.last_time > (now - self.max_age) * 1000):
+                break
+            for path in (segment.path, segment.index_path):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            self.segments.pop(0)
+            size -= segment.size
+
+    def append(self, lines: list, timestamp: float = None):
+        if not lines:
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        ms = int(timestamp * 1000)
+
+        with self._lock:
+            try:
+                segment = self._active_segment()
+                records = []
+                index = array('q')
+                offset = segment.size
+                seq = self.next_seq
+                for line in lines:
+                    record = b'%d %d %s\n' % (seq, ms, line.encode('utf-8', 'replace'))
+                    if offset >= self._next_indexed:
+                        index.extend((seq, ms, offset))
+                        self._next_indexed = offset + self.index_interval
+                    records.append(record)
+                    offset += len(record)
+                    seq += 1
+
+                self._file.write(b''.join(records))
+                self._file.flush()
+                if index:
+                    self._index_file.write(index.tobytes())
+                    self._index_file.flush()
+            except OSError as exc:
+                # lines are still published to the in-memory buffer, only their history is lost
+                if not self._failing:
+                    logger.error(f"Failed to write to the log spool: {exc}")
+                self._failing = True
+                self._close()
+                return
+            self._failing = False
+
+            for i in range(0, len(index), 3):
+                segment.add_index(*index[i:i + 3])
+            segment.size = offset
+            segment.last_seq, segment.last_time = seq - 1, ms
+            self.next_seq = seq
+
+            if timestamp - self._last_eviction >= EVICTION_INTERVAL:
+                self._evict(timestamp)
+
+    def query(self,
+              start: float = None,
+              end: float = None,
+              since: int = None,
+              until: int = None,
+              log_filter: callable = None,
+              limit: int = 1000,
+              chunk_size: int = 500):
+        """
+        Returns an iterator of (next, lines) chunks of at most chunk_size lines, lines are (seq, timestamp, line)
+        tuples with seq in [since, until] and timestamp in [start, end] that pass log_filter, at most limit in total
+        next is the seq to pass as since to continue after the chunk
+        """
+        if limit < 1 or chunk_size < 1:
+            raise ValueError("Limit and chunk size must be at least 1")
+
+        with self._lock:
+            # the index of the segment being written keeps growing, only it's entries up to now are used
+            segments = [(segment, segment.size, len(segment.offsets)) for segment in self.segments if segment.size]
+            next_seq = self.next_seq
+
+        return self._scan(segments, next_seq,
+                          int(start * 1000) if start is not None else None,
+                          int(end * 1000) if end is not None else None,
+                          since, until, log_filter, limit, chunk_size)
+
+    @staticmethod
+    def _start_position(segment: Segment, indexed: int, start: int = None, since: int = None) -> int:
+        if not indexed:
+            return 0
+        i = 0
+        if since is not None:
+            i = max(bisect_right(segment.seqs, since, 0, indexed) - 1, i)
+        if start is not None:
+            # several records share a millisecond, start before the first of them
+            i = max(bisect_left(segment.times, start, 0, indexed) - 1, i)
+        return segment.offsets[i]
+
+    def _scan(self, segments: list, next_seq: int, start: int, end: int, since: int, until: int,
+              log_filter: callable, limit: int, chunk_size: int):
+        # skip whole segments ending before the range, a segment ends where the next one starts
+        first = 0
+        for i, (segment, _, indexed) in enumerate(segments[1:], 1):
+            if (since is not None and segment.first_seq <= since) or \
+                    (start is not None and indexed and segment.times[0] < start):
+                first = i
+
+        chunk = []
+        count = 0
+        cursor = since or 0
+        for segment, size, indexed in segments[first:]:
+            try:
+                f = open(segment.path, 'rb')
+            except FileNotFoundError:  # evicted since the query started
+                continue
+            with f, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                position = self._start_position(segment, indexed, start, since)
+                for seq, timestamp, line in iter_records(mm, position, size):
+                    if (until is not None and seq > until) or (end is not None and timestamp > end):
+                        yield seq, tuple(chunk)
+                        return
+                    cursor = seq + 1
+                    if (since is not None and seq < since) or (start is not None and timestamp < start):
+                        continue
+                    if log_filter is not None and not log_filter([line]):
+                        continue
+
+                    chunk.append((seq, timestamp / 1000, line))
+                    count += 1
+                    if count >= limit:
+                        yield cursor, tuple(chunk)
+                        return
+                    if len(chunk) >= chunk_size:
+                        yield cursor, tuple(chunk)
+                        chunk = []
+
+        yield max(cursor, next_seq), tuple(chunk)
@@ -1,31 +1,31 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-import uvicorn
-from rpyc.utils.authenticators import SSLAuthenticator
-from rpyc.utils.server import ThreadedServer
-
-import rest_service
-import rpyc_service
-from certificate import generate_certificate
-from config import (SERVICE_HOST, SERVICE_PORT, SERVICE_PROTOCOL,
-                    SSL_CERT_FILE, SSL_KEY_FILE, SSL_CLIENT_CERT_FILE)
+from certificate import KEY_TYPES, generate_certificate, write_atomic
+from config import (RPYC_HANDSHAKE_TIMEOUT, RPYC_POOL_SIZE, SERVICE_HOST, SERVICE_PORT, SERVICE_PROTOCOL,
+                    SSL_CERT_FILE, SSL_KEY_FILE, SSL_CLIENT_CERT_FILE, SSL_KEY_TYPE)
 from logger import logger
 
 
 def generate_ssl_files():
-    pems = generate_certificate()
-
-    with open(SSL_KEY_FILE, 'w') as f:
-        f.write(pems['key'])
+    pems = generate_certificate(SSL_KEY_TYPE)
 
-    with open(SSL_CERT_FILE, 'w') as f:
-        f.write(pems['cert'])
+    # the key goes first, a cert file is only ever written next to it's complete key
+    write_atomic(SSL_KEY_FILE, pems['key'], mode=0o600)
+    write_atomic(SSL_CERT_FILE, pems['cert'])
+    logger.info(f"Generated a {SSL_KEY_TYPE} SSL certificate")
 
 
 if __name__ == "__main__":
+    if SSL_KEY_TYPE not in KEY_TYPES:
+        logger.error(f"SSL_KEY_TYPE must be one of ({', '.join(KEY_TYPES)}).")
+        exit(0)
+
+    # the certificate is generated while the protocol stack is imported, it's waited for before listening
+    ssl_files = None
     if not all((os.path.isfile(SSL_CERT_FILE),
                 os.path.isfile(SSL_KEY_FILE))):
-        generate_ssl_files()
+        ssl_files = ThreadPoolExecutor(max_workers=1).submit(generate_ssl_files)
 
     if not SSL_CLIENT_CERT_FILE:
         logger.warning(
@@ -35,13 +35,23 @@ if __name__ == "__main__":
         logger.error("Client's certificate file specified on SSL_CLIENT_CERT_FILE is missing")
         exit(0)
 
+    # only the selected protocol's stack is imported, each service module creates it's core on import
     if SERVICE_PROTOCOL == 'rpyc':
+        from rpyc.utils.authenticators import SSLAuthenticator
+
+        import rpyc_service
+
+        if ssl_files is not None:
+            ssl_files.result()
+
         authenticator = SSLAuthenticator(keyfile=SSL_KEY_FILE,
                                          certfile=SSL_CERT_FILE,
                                          ca_certs=SSL_CLIENT_CERT_FILE or None)
-        thread = ThreadedServer(rpyc_service.XrayService(),
-                                port=SERVICE_PORT,
-                                authenticator=authenticator)
+        thread = rpyc_service.PooledServer(rpyc_service.XrayService(),
+                                           port=SERVICE_PORT,
+                                           authenticator=authenticator,
+                                           pool_size=RPYC_POOL_SIZE,
+                                           handshake_timeout=RPYC_HANDSHAKE_TIMEOUT)
         logger.info(f"Node service running on :{SERVICE_PORT}")
         thread.start()
 
@@ -50,6 +60,13 @@ if __name__ == "__main__":
             logger.error("SSL_CLIENT_CERT_FILE is required for rest service.")
             exit(0)
 
+        import uvicorn
+
+        import rest_service
+
+        if ssl_files is not None:
+            ssl_files.result()
+
         logger.info(f"Node service running on :{SERVICE_PORT}")
         uvicorn.run(
             rest_service.app,
@@ -61,6 +78,29 @@ if __name__ == "__main__":
             ssl_cert_reqs=2
         )
 
+    elif SERVICE_PROTOCOL == 'websocket':
+        if not SSL_CLIENT_CERT_FILE:
+            logger.error("SSL_CLIENT_CERT_FILE is required for websocket service.")
+            exit(0)
+
+        import uvicorn
+
+        import ws_service
+
+        if ssl_files is not None:
+            ssl_files.result()
+
+        logger.info(f"Node service running on :{SERVICE_PORT}")
+        uvicorn.run(
+            ws_service.app,
+            host=SERVICE_HOST,
+            port=SERVICE_PORT,
+            ssl_keyfile=SSL_KEY_FILE,
+            ssl_certfile=SSL_CERT_FILE,
+            ssl_ca_certs=SSL_CLIENT_CERT_FILE,
+            ssl_cert_reqs=2
+        )
+
     else:
-        logger.error("SERVICE_PROTOCOL is not any of (rpyc, rest).")
+        logger.error("SERVICE_PROTOCOL is not any of (rpyc, rest, websocket).")
         exit(0)
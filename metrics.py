@@ -0,0 +1,178 @@
+import bisect
+import functools
+import math
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+        for k, v in labels.items()
+    )
+    return '{' + pairs + '}'
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric(object):
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), registry: "Registry" = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[label]) for label in self.labelnames)
+
+    def samples(self):
+        """Yields (name, labels, value) of every sample of the metric"""
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS, registry: "Registry" = None):
+        self.buckets = tuple(buckets) + (math.inf,)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(key, ([*counts], total, count)) for key, (counts, total, count) in self._values.items()]
+
+        for key, (counts, total, count) in values:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', {**labels, "le": _format_value(bound)}, cumulative
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, count
+
+    def time(self, **labels):
+        """Decorator observing how long the decorated function takes"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start_time = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start_time, **labels)
+            return wrapper
+        return decorator
+
+
+class Registry(object):
+    """
+    Holds metrics and collector functions and renders them in Prometheus text exposition format
+    collectors are called on render and return (name, type, documentation, [(labels, value), ...]) tuples
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = {}
+
+    def register(self, metric: Metric):
+        self._metrics[metric.name] = metric
+
+    def set_collector(self, name: str, func: callable):
+        self._collectors[name] = func
+
+    def remove_collector(self, name: str, func: callable = None):
+        """Removes the collector, only if it's still func when given so a newer one set since is kept"""
+        if func is None or self._collectors.get(name) == func:
+            self._collectors.pop(name, None)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+        for collector in list(self._collectors.values()):
+            for name, type_, documentation, samples in collector():
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {type_}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def sample_process(pid: int) -> dict:
+    """Reads cpu, memory, thread and fd usage of a process from /proc, returns an empty dict where it's not available"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # the command name may contain spaces, fields after it are space separated
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/statm') as f:
+            resident = int(f.read().split()[1])
+        fds = len(os.listdir(f'/proc/{pid}/fd'))
+    except (OSError, IndexError, ValueError):
+        return {}
+
+    return {
+        "cpu_seconds": (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+        "resident_memory_bytes": resident * PAGE_SIZE,
+        "threads": int(fields[17]),
+        "open_fds": fds
+    }
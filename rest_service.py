@@ -1,20 +1,43 @@
 import asyncio
+import functools
+import inspect
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Union
 from uuid import UUID, uuid4
 
 from fastapi import (APIRouter, Body, FastAPI, HTTPException, Request,
                      WebSocket, status)
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import ConfigDict, ValidationError, create_model
 from starlette.websockets import WebSocketDisconnect
 
-from config import XRAY_ASSETS_PATH, XRAY_EXECUTABLE_PATH
+from assets import AssetError, AssetStore
+from config import XRAY_ASSETS_PATH, XRAY_EXECUTABLE_PATH, XRAY_START_TIMEOUT
+from configpatch import PatchError
+from logfilter import LogFilter
 from logger import logger
-from xray import XRayConfig, XRayCore
+from metrics import REGISTRY, Histogram
+from transfer import DecompressMiddleware, supported_encodings
+from xray import VALIDATOR, ConfigValidationError, XRayConfig, XRayCore
 
 app = FastAPI()
+app.add_middleware(DecompressMiddleware)
+
+REQUEST_DURATION = Histogram("marzban_node_request_duration_seconds",
+                             "Seconds spent handling REST requests", ("path",))
+
+
+@app.middleware("http")
+async def observe_request_duration(request: Request, call_next):
+    start_time = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get('route')
+    REQUEST_DURATION.observe(time.perf_counter() - start_time, path=getattr(route, 'path', 'unknown'))
+    return response
 
 
 @app.exception_handler(RequestValidationError)
@@ -39,8 +62,26 @@ class Service(object):
             executable_path=XRAY_EXECUTABLE_PATH,
             assets_path=XRAY_ASSETS_PATH
         )
-        self.core_version = self.core.get_version()
+        self.core_version = self.core.version
+        self.assets = AssetStore(XRAY_ASSETS_PATH)
         self.config = None
+        self._core_operations = ThreadPoolExecutor(max_workers=1, thread_name_prefix='core-operations')
+
+        # operations /batch accepts, by the path of their own endpoint
+        self.batch_operations = {
+            "/": lambda: self.response(**self.core.supervisor_stats),
+            "/ping": lambda: {},
+            "/start": self._start,
+            "/stop": self._stop,
+            "/restart": self._restart,
+            "/users": self._alter_users,
+            "/stats": self.core.get_stats,
+            "/stats/history": self.core.get_stats_history,
+            "/access": self.core.get_access_summary,
+            "/limits": self._set_user_limits,
+            "/enforcement/events": self.core.get_enforcement_events,
+            "/assets": lambda: {"assets": self.assets.manifest()}
+        }
 
         self.router.add_api_route("/", self.base, methods=["POST"])
         self.router.add_api_route("/ping", self.ping, methods=["POST"])
@@ -49,9 +90,37 @@ class Service(object):
         self.router.add_api_route("/start", self.start, methods=["POST"])
         self.router.add_api_route("/stop", self.stop, methods=["POST"])
         self.router.add_api_route("/restart", self.restart, methods=["POST"])
+        self.router.add_api_route("/users", self.alter_users, methods=["POST"])
+        self.router.add_api_route("/stats", self.get_stats, methods=["POST"])
+        self.router.add_api_route("/stats/history", self.get_stats_history, methods=["POST"])
+
+        self.router.add_api_route("/access", self.get_access_summary, methods=["POST"])
+        self.router.add_api_route("/limits", self.set_user_limits, methods=["POST"])
+        self.router.add_api_route("/enforcement/events", self.get_enforcement_events, methods=["POST"])
+        self.router.add_api_route("/logs/history", self.get_log_history, methods=["POST"])
+        self.router.add_api_route("/assets", self.get_assets, methods=["POST"])
+        self.router.add_api_route("/assets/upload", self.begin_asset_upload, methods=["POST"])
+        self.router.add_api_route("/assets/upload/chunk", self.upload_asset_chunk, methods=["POST"])
+        self.router.add_api_route("/assets/install", self.install_asset, methods=["POST"])
+        self.router.add_api_route("/batch", self.batch, methods=["POST"])
+        self.router.add_api_route("/metrics", self.metrics, methods=["GET"])
 
         self.router.add_websocket_route("/logs", self.logs)
 
+        # batch params are validated like the bodies of the endpoints the operations stand for
+        endpoints = {route.path: route.endpoint for route in self.router.routes}
+        self.batch_models = {path: self.params_model(endpoints[path]) for path in self.batch_operations}
+
+    @staticmethod
+    def params_model(endpoint: callable):
+        """Builds a model of the body params an endpoint takes besides session_id, unknown params are rejected"""
+        fields = {
+            name: (parameter.annotation, parameter.default)
+            for name, parameter in inspect.signature(endpoint).parameters.items()
+            if name != 'session_id'
+        }
+        return create_model(f'{endpoint.__name__}_params', __config__=ConfigDict(extra='forbid'), **fields)
+
     def match_session_id(self, session_id: UUID):
         if session_id != self.session_id:
             raise HTTPException(
@@ -65,33 +134,93 @@ class Service(object):
             "connected": self.connected,
             "started": self.core.started,
             "core_version": self.core_version,
+            "config_hash": self.core.config.hash if self.core.config is not None else None,
             **kwargs
         }
 
-    def base(self):
-        return self.response()
+    def wait_ready(self):
+        try:
+            return self.core.wait_ready(XRAY_START_TIMEOUT)
+        except TimeoutError as exc:
+            if not self.core.started:
+                raise RuntimeError(str(exc))
+            logger.warning(f"{exc}, core is still running though")
+
+    def load_config(self, config, base_hash: str = None, patch: list = None) -> XRayConfig:
+        """
+        Builds the config from either the whole config (a json string or object)
+        or a JSON patch against the config with base_hash, which must be the current one
+        """
+        if patch is None:
+            if config is None:
+                raise HTTPException(
+                    status_code=422,
+                    detail={"config": "Either config or patch must be given"}
+                )
+            try:
+                return XRayConfig.load(config, self.client_ip, self.core.config)
+            except json.decoder.JSONDecodeError as exc:
+                raise HTTPException(
+                    status_code=422,
+                    detail={
+                        "config": f'Failed to decode config: {exc}'
+                    }
+                )
+
+        current = self.core.config
+        if current is None or current.hash != base_hash:
+            raise HTTPException(
+                status_code=409,
+                detail={
+                    "config": "Base config hash doesn't match the current one, send the whole config",
+                    "config_hash": current.hash if current is not None else None
+                }
+            )
+        try:
+            return current.patch(patch, self.client_ip)
+        except PatchError as exc:
+            raise HTTPException(
+                status_code=422,
+                detail={
+                    "patch": f'Failed to apply patch: {exc}'
+                }
+            )
 
-    def connect(self, request: Request):
+    async def core_operation(self, func: callable, *args):
+        """
+        Runs func on the single core operations worker, so operations changing the core run one at a time
+        in the order they were requested while the event loop keeps serving other requests
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._core_operations, functools.partial(func, *args))
+
+    def stop_core(self):
+        try:
+            self.core.stop()
+        except RuntimeError:
+            pass
+
+    async def base(self):
+        return self.response(**self.core.supervisor_stats)
+
+    async def connect(self, request: Request):
         self.session_id = uuid4()
         self.client_ip = request.client.host
 
         if self.connected:
             logger.warning(
                 f'New connection from {self.client_ip}, Core control access was taken away from previous client.')
-            if self.core.started:
-                try:
-                    self.core.stop()
-                except RuntimeError:
-                    pass
+            await self.core_operation(self.stop_core)
 
         self.connected = True
         logger.info(f'{self.client_ip} connected, Session ID = "{self.session_id}".')
 
         return self.response(
-            session_id=self.session_id
+            session_id=self.session_id,
+            content_encodings=supported_encodings()
         )
 
-    def disconnect(self):
+    async def disconnect(self):
         if self.connected:
             logger.info(f'{self.client_ip} disconnected, Session ID = "{self.session_id}".')
 
@@ -99,120 +228,360 @@ class Service(object):
         self.client_ip = None
         self.connected = False
 
-        if self.core.started:
-            try:
-                self.core.stop()
-            except RuntimeError:
-                pass
-
+        await self.core_operation(self.stop_core)
         return self.response()
 
-    def ping(self, session_id: UUID = Body(embed=True)):
+    async def ping(self, session_id: UUID = Body(embed=True)):
         self.match_session_id(session_id)
         return {}
 
-    def start(self, session_id: UUID = Body(embed=True), config: str = Body(embed=True)):
+    async def start(self,
+                    session_id: UUID = Body(embed=True),
+                    config: Union[str, dict, None] = Body(None, embed=True),
+                    base_hash: Optional[str] = Body(None, embed=True),
+                    patch: Optional[list] = Body(None, embed=True)):
+        self.match_session_id(session_id)
+        return await self.core_operation(self._start, config, base_hash, patch)
+
+    def _start(self, config, base_hash: str = None, patch: list = None):
+        config = self.load_config(config, base_hash, patch)
+
+        try:
+            self.core.start(config)
+            time_to_ready = self.wait_ready()
+
+        except Exception as exc:
+            logger.error(f"Failed to start core: {exc}")
+            raise HTTPException(
+                status_code=503,
+                detail=str(exc)
+            )
+
+        return self.response(
+            time_to_ready=time_to_ready
+        )
+
+    async def stop(self, session_id: UUID = Body(embed=True)):
+        self.match_session_id(session_id)
+
+        return await self.core_operation(self._stop)
+
+    def _stop(self):
+        self.stop_core()
+        return self.response()
+
+    async def restart(self,
+                      session_id: UUID = Body(embed=True),
+                      config: Union[str, dict, None] = Body(None, embed=True),
+                      base_hash: Optional[str] = Body(None, embed=True),
+                      patch: Optional[list] = Body(None, embed=True)):
         self.match_session_id(session_id)
+        return await self.core_operation(self._restart, config, base_hash, patch)
+
+    def _restart(self, config, base_hash: str = None, patch: list = None):
+        config = self.load_config(config, base_hash, patch)
 
         try:
-            config = XRayConfig(config, self.client_ip)
-        except json.decoder.JSONDecodeError as exc:
+            start_time = time.time()
+            result = self.core.update(config)
+            time_to_ready = self.wait_ready() if result["strategy"] == 'restart' else 0
+
+        except ConfigValidationError as exc:
+            logger.error(f"Config rejected, core is left running: {exc}")
             raise HTTPException(
                 status_code=422,
                 detail={
-                    "config": f'Failed to decode config: {exc}'
+                    "config": str(exc)
                 }
             )
 
-        with self.core.get_logs() as logs:
-            try:
-                self.core.start(config)
-
-                start_time = time.time()
-                end_time = start_time + 3
-                last_log = ''
-                while time.time() < end_time:
-                    while logs:
-                        log = logs.popleft()
-                        if log:
-                            last_log = log
-                        if f'Xray {self.core_version} started' in log:
-                            break
-                    time.sleep(0.1)
+        except Exception as exc:
+            logger.error(f"Failed to restart core: {exc}")
+            raise HTTPException(
+                status_code=503,
+                detail=str(exc)
+            )
 
-            except Exception as exc:
-                logger.error(f"Failed to start core: {exc}")
-                raise HTTPException(
-                    status_code=503,
-                    detail=str(exc)
-                )
+        return self.response(
+            **result,
+            duration=round(time.time() - start_time, 3),
+            time_to_ready=time_to_ready
+        )
 
-        if not self.core.started:
+    async def alter_users(self, session_id: UUID = Body(embed=True), inbounds: dict = Body(embed=True)):
+        self.match_session_id(session_id)
+        return await self.core_operation(self._alter_users, inbounds)
+
+    def _alter_users(self, inbounds: dict):
+        try:
+            result = self.core.alter_users(inbounds)
+        except RuntimeError as exc:
             raise HTTPException(
                 status_code=503,
-                detail=last_log
+                detail=str(exc)
             )
 
-        return self.response()
+        return self.response(**result)
 
-    def stop(self, session_id: UUID = Body(embed=True)):
+    def get_stats(self, session_id: UUID = Body(embed=True), cursor: int = Body(0, embed=True)):
         self.match_session_id(session_id)
 
         try:
-            self.core.stop()
+            stats = self.core.get_stats(cursor)
+        except RuntimeError as exc:
+            raise HTTPException(
+                status_code=503,
+                detail=str(exc)
+            )
 
-        except RuntimeError:
-            pass
+        return stats
 
-        return self.response()
+    def get_stats_history(self,
+                          session_id: UUID = Body(embed=True),
+                          users: List[str] = Body([], embed=True),
+                          inbounds: List[str] = Body([], embed=True),
+                          start: float = Body(0, embed=True),
+                          end: Optional[float] = Body(None, embed=True),
+                          resolution: Optional[int] = Body(None, embed=True)):
+        self.match_session_id(session_id)
+        return self.core.get_stats_history(users, inbounds, start, end, resolution)
+
+    def get_access_summary(self, session_id: UUID = Body(embed=True), limit: int = Body(20, embed=True)):
+        self.match_session_id(session_id)
 
-    def restart(self, session_id: UUID = Body(embed=True), config: str = Body(embed=True)):
+        try:
+            return self.core.get_access_summary(limit)
+        except RuntimeError as exc:
+            raise HTTPException(
+                status_code=404,
+                detail=str(exc)
+            )
+
+    def set_user_limits(self,
+                        session_id: UUID = Body(embed=True),
+                        limits: dict = Body(embed=True),
+                        replace: bool = Body(False, embed=True)):
         self.match_session_id(session_id)
+        return self._set_user_limits(limits, replace)
 
+    def _set_user_limits(self, limits: dict, replace: bool = False):
         try:
-            config = XRayConfig(config, self.client_ip)
-        except json.decoder.JSONDecodeError as exc:
+            result = self.core.set_user_limits(limits, replace)
+        except ValueError as exc:
             raise HTTPException(
                 status_code=422,
-                detail={
-                    "config": f'Failed to decode config: {exc}'
-                }
+                detail=str(exc)
             )
 
+        return self.response(**result)
+
+    def get_enforcement_events(self,
+                               session_id: UUID = Body(embed=True),
+                               after: int = Body(0, embed=True),
+                               limit: int = Body(1000, embed=True)):
+        self.match_session_id(session_id)
+        return self.core.get_enforcement_events(after, limit)
+
+    def get_log_history(self,
+                        session_id: UUID = Body(embed=True),
+                        start: Optional[float] = Body(None, embed=True),
+                        end: Optional[float] = Body(None, embed=True),
+                        history_since: Optional[int] = Body(None, embed=True),
+                        history_until: Optional[int] = Body(None, embed=True),
+                        filters: dict = Body({}, embed=True),
+                        limit: int = Body(1000, embed=True),
+                        chunk_size: int = Body(500, embed=True)):
+        """
+        Streams spooled logs as newline delimited json,
+        a {"history_next": history seq, "lines": [[history seq, timestamp, line], ...]} object per chunk,
+        filters are the keyword arguments of LogFilter
+        history seqs are the spool's own and keep increasing across node restarts, they're unrelated to the seqs
+        of /logs (which start over with every core) so they can't be passed to it as since
+        """
+        self.match_session_id(session_id)
+
         try:
-            with self.core.get_logs() as logs:
-                self.core.restart(config)
-
-                start_time = time.time()
-                end_time = start_time + 3
-                last_log = ''
-                while time.time() < end_time:
-                    while logs:
-                        log = logs.popleft()
-                        if log:
-                            last_log = log
-                        if f'Xray {self.core_version} started' in log:
-                            break
-                    time.sleep(0.1)
+            log_filter = LogFilter(**filters) if filters else None
+            chunks = self.core.query_logs(start, end, history_since, history_until, log_filter, limit, chunk_size)
+        except (TypeError, ValueError) as exc:
+            raise HTTPException(
+                status_code=422,
+                detail=str(exc)
+            )
+        except RuntimeError as exc:
+            raise HTTPException(
+                status_code=404,
+                detail=str(exc)
+            )
 
-        except Exception as exc:
-            logger.error(f"Failed to restart core: {exc}")
+        return StreamingResponse((json.dumps({"history_next": history_next, "lines": lines}) + '\n'
+                                  for history_next, lines in chunks),
+                                 media_type="application/x-ndjson")
+
+    def get_assets(self, session_id: UUID = Body(embed=True)):
+        """Returns the sha256 of every file in the assets directory, so only differing ones need uploading"""
+        self.match_session_id(session_id)
+        return {"assets": self.assets.manifest()}
+
+    def begin_asset_upload(self,
+                           session_id: UUID = Body(embed=True),
+                           name: str = Body(embed=True),
+                           sha256: str = Body(embed=True),
+                           size: int = Body(embed=True)):
+        """Starts or resumes an upload, chunks are sent to /assets/upload/chunk from the returned offset"""
+        self.match_session_id(session_id)
+
+        try:
+            return self.assets.begin_upload(name, sha256, size)
+        except AssetError as exc:
             raise HTTPException(
-                status_code=503,
+                status_code=422,
+                detail=str(exc)
+            )
+
+    def upload_asset_chunk(self,
+                           session_id: UUID,
+                           sha256: str,
+                           size: int,
+                           offset: int,
+                           data: bytes = Body(media_type="application/octet-stream")):
+        """Takes the chunk as the raw request body and the rest as query params"""
+        self.match_session_id(session_id)
+
+        try:
+            return self.assets.write_chunk(sha256, size, offset, data)
+        except AssetError as exc:
+            raise HTTPException(
+                status_code=422,
+                detail=str(exc)
+            )
+
+    async def install_asset(self,
+                            session_id: UUID = Body(embed=True),
+                            name: str = Body(embed=True),
+                            sha256: str = Body(embed=True),
+                            size: int = Body(embed=True),
+                            restart: bool = Body(False, embed=True)):
+        self.match_session_id(session_id)
+        return await self.core_operation(self._install_asset, name, sha256, size, restart)
+
+    def _install_asset(self, name: str, sha256: str, size: int, restart: bool = False):
+        try:
+            asset = self.assets.install(name, sha256, size)
+        except AssetError as exc:
+            raise HTTPException(
+                status_code=422,
                 detail=str(exc)
             )
+        # configs tested against the previous assets have to be tested again
+        VALIDATOR.clear()
+
+        if not restart or not self.core.started:
+            return self.response(asset=asset, restart=None)
+
+        try:
+            result = self.core.restart(self.core.config)
+            result["time_to_ready"] = self.wait_ready()
 
-        if not self.core.started:
+        except ConfigValidationError as exc:
+            logger.error(f"Config rejected with the new {name}, core is left running: {exc}")
+            raise HTTPException(
+                status_code=422,
+                detail={
+                    "config": str(exc)
+                }
+            )
+
+        except Exception as exc:
+            logger.error(f"Failed to restart core: {exc}")
             raise HTTPException(
                 status_code=503,
-                detail=last_log
+                detail=str(exc)
             )
 
-        return self.response()
+        return self.response(asset=asset, restart=result)
+
+    async def batch(self,
+                    session_id: UUID = Body(embed=True),
+                    operations: List[dict] = Body(embed=True),
+                    stop_on_error: bool = Body(True, embed=True)):
+        """
+        Runs operations in order under one session check, each is {"path": endpoint path, "params": {...}}
+        with the params its endpoint takes besides session_id
+        returns every result as {"path", "status", "result" or "detail"} and the number of operations skipped
+        after the first failure when stop_on_error is set
+        """
+        self.match_session_id(session_id)
+        return await self.core_operation(self._batch, operations, stop_on_error)
+
+    def _batch(self, operations: list, stop_on_error: bool):
+        results = []
+        for index, operation in enumerate(operations):
+            path = operation.get('path')
+            params = operation.get('params') or {}
+            func = self.batch_operations.get(path)
+            try:
+                if func is None:
+                    raise HTTPException(status_code=404, detail=f'Unknown operation "{path}"')
+                if not isinstance(params, dict):
+                    raise HTTPException(status_code=422, detail="params must be an object")
+                try:
+                    params = self.batch_models[path].model_validate(params)
+                except ValidationError as exc:
+                    raise HTTPException(
+                        status_code=422,
+                        detail={error["loc"][-1] if error["loc"] else "params": error.get("msg")
+                                for error in exc.errors()}
+                    )
+                try:
+                    result = {"path": path, "status": 200, "result": func(**dict(params))}
+                except ValueError as exc:
+                    raise HTTPException(status_code=422, detail=str(exc))
+                except RuntimeError as exc:
+                    raise HTTPException(status_code=503, detail=str(exc))
+            except HTTPException as exc:
+                result = {"path": path, "status": exc.status_code, "detail": exc.detail}
+            except Exception as exc:
+                # one failing operation must not take the results of the ones already run with it
+                logger.exception(f'Batch operation "{path}" failed')
+                result = {"path": path, "status": 500, "detail": str(exc)}
+
+            results.append(result)
+            if result["status"] != 200 and stop_on_error:
+                break
+
+        return self.response(
+            results=results,
+            skipped=len(operations) - len(results)
+        )
+
+    def metrics(self):
+        return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+    @staticmethod
+    def parse_log_filter(params) -> Optional[LogFilter]:
+        """Builds a LogFilter out of /logs query params, returns None if no filter is requested"""
+        kwargs = {}
+        for name in ('level', 'regex', 'email', 'inbound'):
+            if params.get(name):
+                kwargs[name] = params.get(name)
+        if params.getlist('contains'):
+            kwargs['contains'] = params.getlist('contains')
+
+        for name in ('sample', 'max_rate'):
+            if params.get(name):
+                try:
+                    kwargs[name] = float(params.get(name))
+                except ValueError:
+                    raise ValueError(f"Invalid {name} value.")
+
+        if kwargs:
+            return LogFilter(**kwargs)
 
     async def logs(self, websocket: WebSocket):
         session_id = websocket.query_params.get('session_id')
         interval = websocket.query_params.get('interval')
+        since = websocket.query_params.get('since')
 
         try:
             session_id = UUID(session_id)
@@ -232,41 +601,95 @@ class Service(object):
             if interval > 10:
                 return await websocket.close(reason="Interval must be more than 0 and at most 10 seconds.", code=4400)
 
+        if since:
+            try:
+                since = int(since)
+            except ValueError:
+                return await websocket.close(reason="Invalid since value.", code=4400)
+        else:
+            since = None
+
+        try:
+            log_filter = self.parse_log_filter(websocket.query_params)
+        except ValueError as exc:
+            return await websocket.close(reason=str(exc), code=4400)
+
         await websocket.accept()
 
-        cache = ''
+        def format_messages(seq: int, lines: list) -> list:
+            dropped = log_filter.take_rate_limited() if log_filter else 0
+            if since is not None:
+                message = {"seq": seq, "next": logs.cursor, "lines": lines}
+                if dropped:
+                    message["dropped"] = dropped
+                return [json.dumps(message)]
+
+            if dropped:
+                lines = lines + [f'{dropped} lines dropped by max_rate']
+            if interval:
+                return [''.join(f'{line}\n' for line in lines)]
+            return lines
+
+        cache = []
+        cache_seq = None
         last_sent_ts = 0
-        with self.core.get_logs() as logs:
-            while session_id == self.session_id:
-                if interval and time.time() - last_sent_ts >= interval and cache:
-                    try:
-                        await websocket.send_text(cache)
-                    except (WebSocketDisconnect, RuntimeError):
-                        break
-                    cache = ''
-                    last_sent_ts = time.time()
-
-                if not logs:
-                    try:
-                        await asyncio.wait_for(websocket.receive(), timeout=0.2)
-                        continue
-                    except asyncio.TimeoutError:
+        receiver = asyncio.ensure_future(websocket.receive())
+        try:
+            with self.core.get_logs(since, log_filter) as logs:
+                while session_id == self.session_id:
+                    if cache and (not interval or time.time() - last_sent_ts >= interval):
+                        try:
+                            for message in format_messages(cache_seq, cache):
+                                await websocket.send_text(message)
+                        except (WebSocketDisconnect, RuntimeError):
+                            break
+                        cache = []
+                        last_sent_ts = time.time()
+
+                    if not logs:
+                        timeout = 1
+                        if interval and cache:
+                            timeout = max(interval - (time.time() - last_sent_ts), 0)
+
+                        waiter = asyncio.ensure_future(logs.wait_async())
+                        done, _ = await asyncio.wait((receiver, waiter),
+                                                     timeout=timeout,
+                                                     return_when=asyncio.FIRST_COMPLETED)
+                        waiter.cancel()
+
+                        if receiver in done:
+                            try:
+                                message = receiver.result()
+                            except (WebSocketDisconnect, RuntimeError):
+                                break
+                            if message.get('type') == 'websocket.disconnect':
+                                break
+                            receiver = asyncio.ensure_future(websocket.receive())
                         continue
-                    except (WebSocketDisconnect, RuntimeError):
-                        break
-
-                log = logs.popleft()
 
-                if interval:
-                    cache += f'{log}\n'
-                    continue
+                    seq, lines, missed = logs.read()
+                    if missed and since is not None:
+                        # lines were evicted before we could send them, let the client know about the gap
+                        try:
+                            if cache:
+                                for message in format_messages(cache_seq, cache):
+                                    await websocket.send_text(message)
+                                cache = []
+                            await websocket.send_text(json.dumps({"seq": seq, "gap": missed}))
+                        except (WebSocketDisconnect, RuntimeError):
+                            break
 
-                try:
-                    await websocket.send_text(log)
-                except (WebSocketDisconnect, RuntimeError):
-                    break
+                    if lines:
+                        if not cache:
+                            cache_seq = seq
+                        cache.extend(lines)
+        finally:
+            receiver.cancel()
 
-        await websocket.close()
+        try:
+            await websocket.close()
+        except RuntimeError:
+            pass
 
 
 service = Service()
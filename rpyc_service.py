@@ -1,43 +1,253 @@
+import json
+import threading
 import time
-from socket import socket
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from socket import SHUT_RDWR, socket
 
 import rpyc
+from rpyc.core.async_ import AsyncResult
+from rpyc.utils.authenticators import AuthenticationError
+from rpyc.utils.server import ThreadedServer
 
-from config import XRAY_ASSETS_PATH, XRAY_EXECUTABLE_PATH
+from assets import AssetStore
+from config import (ENFORCEMENT_INTERVAL, XRAY_ASSETS_PATH,
+                    XRAY_EXECUTABLE_PATH, XRAY_START_TIMEOUT)
+from enforcement import Enforcer
+from logfilter import LogFilter
 from logger import logger
-from xray import XRayConfig, XRayCore
+from metrics import REGISTRY, Histogram
+from transfer import decompress
+from xray import LOG_SPOOL, VALIDATOR, XRayConfig, XRayCore
+
+
+# methods batch can call, every exposed one but the callback based fetch_logs, the streamed fetch_log_history
+# and batch itself
+BATCH_METHODS = ('start', 'stop', 'restart', 'alter_users', 'set_user_limits', 'fetch_stats', 'fetch_stats_history',
+                 'fetch_access_summary', 'fetch_enforcement_events', 'fetch_supervisor_stats', 'fetch_config_hash',
+                 'fetch_xray_version', 'fetch_metrics', 'fetch_assets')
+
+# seconds to wait for a peer to acknowledge a log batch before sending the next one anyway
+CALLBACK_TIMEOUT = 30
+
+CALL_DURATION = Histogram("marzban_node_rpyc_call_duration_seconds",
+                          "Seconds spent handling rpyc calls", ("method",))
 
 
 class XrayCoreLogsHandler(object):
-    def __init__(self, core: XRayCore, callback: callable, interval: float = 0.6):
+    """
+    Delivers a core's logs to a peer's callback, handlers don't have threads of their own,
+    LOG_DISPATCHER flushes all of them from one thread
+    callbacks to peers are async, a handler waits for the previous batch to be acknowledged before sending the next,
+    so a slow peer only delays itself and lines it can't keep up with are reported as gaps by the log buffer
+    """
+
+    def __init__(self, core: XRayCore, callback: callable, interval: float = 0.6, since: int = None,
+                 log_filter: LogFilter = None):
         self.core = core
-        self.callback = callback
         self.interval = interval
+        self.since = since
+        self.log_filter = log_filter
         self.active = True
-        self.thread = Thread(target=self.cast)
-        self.thread.start()
+        self.last_sent_ts = 0
+
+        try:
+            self.callback = rpyc.async_(callback)
+        except TypeError:  # a local callable
+            self.callback = callback
+        self._pending = None
+        self._pending_since = 0
+
+        self._subscription = core.get_logs(since, log_filter)
+        self.logs = self._subscription.__enter__()
+        self.logs.listener = LOG_DISPATCHER.wake
+        LOG_DISPATCHER.add(self)
 
     def stop(self):
+        if not self.active:
+            return
         self.active = False
-        self.thread.join()
+        LOG_DISPATCHER.remove(self)
+        self._subscription.__exit__(None, None, None)
+
+    def _call(self, message: str):
+        result = self.callback(message)
+        if isinstance(result, AsyncResult):
+            self._pending = result
+            self._pending_since = time.monotonic()
+            result.add_callback(self._acknowledged)
+
+    def _acknowledged(self, result: AsyncResult):
+        if self._pending is result:
+            self._pending = None
+            LOG_DISPATCHER.wake()
+
+    def send(self, seq: int, lines: list):
+        dropped = self.log_filter.take_rate_limited() if self.log_filter else 0
+        if self.since is None:
+            if dropped:
+                lines = lines + [f'{dropped} lines dropped by max_rate']
+            self._call(''.join(f'{line}\n' for line in lines))
+        else:
+            message = {"seq": seq, "next": self.logs.cursor, "lines": lines}
+            if dropped:
+                message["dropped"] = dropped
+            self._call(json.dumps(message))
+
+    def flush(self):
+        """
+        Sends the lines published since the last batch if the interval has passed and the peer is caught up,
+        returns seconds until the handler needs flushing again, None if not before new lines or an acknowledgement
+        """
+        if not self.logs:
+            return None
+        wait = self.interval - (time.time() - self.last_sent_ts)
+        if wait > 0:
+            return wait
+        if self._pending is not None:
+            waited = time.monotonic() - self._pending_since
+            if waited < CALLBACK_TIMEOUT:
+                return CALLBACK_TIMEOUT - waited
+            self._pending = None
+
+        seq, lines, missed = self.logs.read()
+        if missed and self.since is not None:
+            self._call(json.dumps({"seq": seq, "gap": missed}))
+        if lines:
+            self.send(seq, lines)
+        self.last_sent_ts = time.time()
+        return None
 
-    def cast(self):
-        with self.core.get_logs() as logs:
-            cache = ''
-            last_sent_ts = 0
-            while self.active:
-                if time.time() - last_sent_ts >= self.interval and cache:
-                    self.callback(cache)
-                    cache = ''
-                    last_sent_ts = time.time()
+    def stats(self):
+        return self.logs.stats() if self.logs is not None else {}
 
-                if not logs:
-                    time.sleep(0.2)
-                    continue
 
-                log = logs.popleft()
-                cache += f'{log}\n'
+class LogDispatcher(object):
+    """
+    Flushes every active XrayCoreLogsHandler from a single thread,
+    which sleeps until lines are published, a batch is acknowledged or a handler's interval is over
+    and exits once the last handler is removed
+    """
+
+    def __init__(self):
+        self.handlers = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def wake(self):
+        self._wake.set()
+
+    def add(self, handler: XrayCoreLogsHandler):
+        with self._lock:
+            self.handlers.add(handler)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def remove(self, handler: XrayCoreLogsHandler):
+        with self._lock:
+            self.handlers.discard(handler)
+        self._wake.set()
+
+    def run(self):
+        timeout = None
+        while True:
+            self._wake.wait(timeout)
+            # cleared before flushing, so lines published meanwhile wake the next round
+            self._wake.clear()
+            with self._lock:
+                handlers = list(self.handlers)
+                if not handlers:
+                    self._thread = None
+                    return
+
+            delays = []
+            for handler in handlers:
+                try:
+                    delay = handler.flush()
+                    if delay is not None:
+                        delays.append(delay)
+                except (EOFError, ReferenceError, OSError) as exc:
+                    # peer is gone
+                    logger.debug(f"Stopped sending logs: {exc}")
+                    handler.stop()
+                except Exception as exc:
+                    logger.error(f"Failed to send logs: {exc}")
+                    handler.stop()
+            timeout = min(delays) if delays else None
+
+
+LOG_DISPATCHER = LogDispatcher()
+
+
+class PooledServer(ThreadedServer):
+    """
+    ThreadedServer that serves connections on a bounded pool instead of a new thread each,
+    connections beyond pool_size wait for a free worker, rejected ones are closed right after the handshake
+    TLS handshakes run on a pool of handshake_workers and must finish within handshake_timeout seconds of the accept,
+    at most handshake_backlog more wait for a worker and connections beyond that are closed right away,
+    so a reconnect storm or connections that never finish the handshake can't grow the thread count
+    """
+
+    def __init__(self, *args, pool_size: int = 20, handshake_timeout: float = 10,
+                 handshake_workers: int = 4, handshake_backlog: int = 64, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='rpyc-connections')
+        self.handshakes = ThreadPoolExecutor(max_workers=handshake_workers, thread_name_prefix='rpyc-handshakes')
+        self.handshake_timeout = handshake_timeout
+        # handshakes running or waiting for a worker
+        self._handshake_slots = threading.BoundedSemaphore(handshake_workers + handshake_backlog)
+
+    def _accept_method(self, sock):
+        if not self._handshake_slots.acquire(blocking=False):
+            self.logger.info("Rejecting connection, too many pending handshakes")
+            self._close_client(sock)
+            return
+        self.handshakes.submit(self._authenticate, sock, time.monotonic() + self.handshake_timeout)
+
+    def _authenticate(self, sock, deadline: float):
+        try:
+            addrinfo = sock.getpeername()
+            if self.authenticator:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise AuthenticationError("waited too long for a handshake worker")
+                sock.settimeout(timeout)
+                sock2, credentials = self.authenticator(sock)
+                sock2.settimeout(None)
+            else:
+                sock2, credentials = sock, None
+        except (AuthenticationError, OSError) as exc:
+            self.logger.info(f"Rejecting connection, handshake failed: {exc}")
+            self._close_client(sock)
+            return
+        finally:
+            self._handshake_slots.release()
+
+        self.pool.submit(self._serve_authenticated, sock, sock2, credentials, addrinfo)
+
+    def _serve_authenticated(self, sock, sock2, credentials, addrinfo):
+        try:
+            self.logger.info(f"{addrinfo} authenticated successfully")
+            self._serve_client(sock2, credentials)
+        except Exception:
+            self.logger.exception("client connection terminated abruptly")
+        finally:
+            self._close_client(sock)
+
+    def _close_client(self, sock):
+        try:
+            sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+        self.clients.discard(sock)
+
+    def close(self):
+        super().close()
+        self.handshakes.shutdown(wait=False, cancel_futures=True)
+        self.pool.shutdown(wait=False, cancel_futures=True)
 
 
 @rpyc.service
@@ -45,6 +255,11 @@ class XrayService(rpyc.Service):
     def __init__(self):
         self.core = None
         self.connection = None
+        self.log_handlers = set()
+        self.assets = AssetStore(XRAY_ASSETS_PATH)
+        # every start makes a new core, closing the previous one, they all share the enforcer
+        # so pushed limits outlive restarts
+        self.enforcer = Enforcer(interval=ENFORCEMENT_INTERVAL)
 
     def on_connect(self, conn):
         if self.connection:
@@ -68,21 +283,60 @@ class XrayService(rpyc.Service):
         if conn is self.connection:
             logger.warning(f'Disconnected from {self.connection.peer}')
 
+            for handler in list(self.log_handlers):
+                handler.stop()
+            self.log_handlers.clear()
+
             if self.core is not None:
-                self.core.stop()
+                self.core.close()
 
             self.core = None
             self.connection = None
 
+    def wait_ready(self):
+        try:
+            return self.core.wait_ready(XRAY_START_TIMEOUT)
+        except TimeoutError as exc:
+            if not self.core.started:
+                raise RuntimeError(str(exc))
+            logger.warning(f"{exc}, core is still running though")
+
+    def load_config(self, config=None, base_hash: str = None, patch=None) -> XRayConfig:
+        """
+        Builds the config from either the whole config or a JSON patch against the current config with base_hash,
+        both may be json strings or gzip/zstd compressed bytes
+        """
+        if patch is None:
+            if isinstance(config, bytes):
+                config = decompress(config)
+            return XRayConfig.load(config, self.connection.peer,
+                                   self.core.config if self.core is not None else None)
+
+        current = self.core.config if self.core is not None else None
+        if current is None or current.hash != base_hash:
+            raise ValueError("Base config hash doesn't match the current one, send the whole config")
+        if isinstance(patch, bytes):
+            patch = decompress(patch)
+        return current.patch(json.loads(patch), self.connection.peer)
+
+    @rpyc.exposed
+    @CALL_DURATION.time(method="fetch_config_hash")
+    def fetch_config_hash(self):
+        if self.core is None or self.core.config is None:
+            return None
+        return self.core.config.hash
+
     @rpyc.exposed
-    def start(self, config: str):
+    @CALL_DURATION.time(method="start")
+    def start(self, config=None, base_hash: str = None, patch=None):
+        config = self.load_config(config, base_hash, patch)
         if self.core is not None:
             self.stop()
 
         try:
-            config = XRayConfig(config, self.connection.peer)
             self.core = XRayCore(executable_path=XRAY_EXECUTABLE_PATH,
-                                 assets_path=XRAY_ASSETS_PATH)
+                                 assets_path=XRAY_ASSETS_PATH,
+                                 enforcer=self.enforcer)
 
             if self.connection and hasattr(self.connection.root, 'on_start'):
                 @self.core.on_start
@@ -109,25 +363,104 @@ class XrayService(rpyc.Service):
                     "Peer doesn't have on_stop function on it's service, skipped")
 
             self.core.start(config)
+            return {
+                "config_hash": config.hash,
+                "time_to_ready": self.wait_ready()
+            }
         except Exception as exc:
             logger.error(exc)
             raise exc
 
     @rpyc.exposed
+    @CALL_DURATION.time(method="stop")
     def stop(self):
         if self.core:
             try:
-                self.core.stop()
+                self.core.close()
             except RuntimeError:
                 pass
         self.core = None
 
     @rpyc.exposed
-    def restart(self, config: str):
-        config = XRayConfig(config, self.connection.peer)
-        self.core.restart(config)
+    @CALL_DURATION.time(method="restart")
+    def restart(self, config=None, base_hash: str = None, patch=None) -> dict:
+        if self.core is None:
+            raise ProcessLookupError("Xray has not been started")
+
+        config = self.load_config(config, base_hash, patch)
+        start_time = time.time()
+        result = self.core.update(config)
+        time_to_ready = self.wait_ready() if result["strategy"] == 'restart' else 0
+        return {
+            **result,
+            "config_hash": config.hash,
+            "duration": round(time.time() - start_time, 3),
+            "time_to_ready": time_to_ready
+        }
+
+    @rpyc.exposed
+    @CALL_DURATION.time(method="alter_users")
+    def alter_users(self, inbounds: str) -> dict:
+        if self.core is None:
+            raise ProcessLookupError("Xray has not been started")
+
+        if isinstance(inbounds, str):
+            inbounds = json.loads(inbounds)
+        return self.core.alter_users(inbounds)
 
     @rpyc.exposed
+    @CALL_DURATION.time(method="fetch_stats")
+    def fetch_stats(self, cursor: int = 0) -> dict:
+        if self.core is None:
+            raise ProcessLookupError("Xray has not been started")
+
+        return self.core.get_stats(cursor)
+
+    @rpyc.exposed
+    @CALL_DURATION.time(method="fetch_stats_history")
+    def fetch_stats_history(self, users: list = (), inbounds: list = (),
+                            start: float = 0, end: float = None, resolution: int = None) -> dict:
+        if self.core is None:
+            raise ProcessLookupError("Xray has not been started")
+
+        return self.core.get_stats_history(list(users), list(inbounds), start, end, resolution)
+
+    @rpyc.exposed
+    @CALL_DURATION.time(method="fetch_access_summary")
+    def fetch_access_summary(self, limit: int = 20) -> dict:
+        if self.core is None:
+            raise ProcessLookupError("Xray has not been started")
+
+        return self.core.get_access_summary(limit)
+
+    @rpyc.exposed
+    @CALL_DURATION.time(method="set_user_limits")
+    def set_user_limits(self, limits: str, replace: bool = False) -> dict:
+        if self.core is None:
+            raise ProcessLookupError("Xray has not been started")
+
+        if isinstance(limits, str):
+            limits = json.loads(limits)
+        return self.core.set_user_limits(limits, replace)
+
+    @rpyc.exposed
+    @CALL_DURATION.time(method="fetch_enforcement_events")
+    def fetch_enforcement_events(self, after: int = 0, limit: int = 1000) -> dict:
+        if self.core is None:
+            raise ProcessLookupError("Xray has not been started")
+
+        return self.core.get_enforcement_events(after, limit)
+
+    @rpyc.exposed
+    @CALL_DURATION.time(method="fetch_supervisor_stats")
+    def fetch_supervisor_stats(self) -> dict:
+        if self.core is None:
+            raise ProcessLookupError("Xray has not been started")
+
+        return self.core.supervisor_stats
+
+    @rpyc.exposed
+    @CALL_DURATION.time(method="fetch_xray_version")
     def fetch_xray_version(self):
         if self.core is None:
             raise ProcessLookupError("Xray has not been started")
@@ -135,9 +468,100 @@ class XrayService(rpyc.Service):
         return self.core.version
 
     @rpyc.exposed
-    def fetch_logs(self, callback: callable) -> XrayCoreLogsHandler:
+    @CALL_DURATION.time(method="fetch_logs")
+    def fetch_logs(self, callback: callable, since: int = None, **filters) -> XrayCoreLogsHandler:
+        """filters are the keyword arguments of LogFilter (level, contains, regex, email, inbound, sample, max_rate)"""
         if self.core:
-            logs = XrayCoreLogsHandler(self.core, callback)
+            log_filter = LogFilter(**filters) if filters else None
+            logs = XrayCoreLogsHandler(self.core, callback, since=since, log_filter=log_filter)
             logs.exposed_stop = logs.stop
-            logs.exposed_cast = logs.cast
+            logs.exposed_cast = logs.flush
+            logs.exposed_stats = logs.stats
+            self.log_handlers = {handler for handler in self.log_handlers if handler.active}
+            self.log_handlers.add(logs)
             return logs
+
+    @rpyc.exposed
+    @CALL_DURATION.time(method="fetch_log_history")
+    def fetch_log_history(self, start: float = None, end: float = None,
+                          history_since: int = None, history_until: int = None,
+                          limit: int = 1000, chunk_size: int = 500, **filters):
+        """
+        Returns an iterator of (history next, lines) chunks of the spooled logs,
+        lines are (history seq, timestamp, line) tuples,
+        both are tuples so each chunk is passed by value in one round trip, works without a started core
+        history seqs are the spool's own and unrelated to fetch_logs' since, which starts over with every core
+        """
+        if LOG_SPOOL is None:
+            raise RuntimeError("Log spool is disabled")
+
+        log_filter = LogFilter(**filters) if filters else None
+        return LOG_SPOOL.query(start, end, history_since, history_until, log_filter, limit, chunk_size)
+
+    @rpyc.exposed
+    @CALL_DURATION.time(method="fetch_assets")
+    def fetch_assets(self) -> dict:
+        """Returns {name: {"sha256", "size", "modified"}} of the assets directory, works without a started core"""
+        return self.assets.manifest()
+
+    @rpyc.exposed
+    @CALL_DURATION.time(method="begin_asset_upload")
+    def begin_asset_upload(self, name: str, sha256: str, size: int) -> dict:
+        return self.assets.begin_upload(name, sha256, size)
+
+    @rpyc.exposed
+    @CALL_DURATION.time(method="upload_asset_chunk")
+    def upload_asset_chunk(self, sha256: str, size: int, offset: int, data: bytes) -> dict:
+        return self.assets.write_chunk(sha256, size, offset, data)
+
+    @rpyc.exposed
+    @CALL_DURATION.time(method="install_asset")
+    def install_asset(self, name: str, sha256: str, size: int, restart: bool = False) -> dict:
+        """Installs a fully uploaded asset and restarts a started core with it's current config if restart is set"""
+        asset = self.assets.install(name, sha256, size)
+        # configs tested against the previous assets have to be tested again
+        VALIDATOR.clear()
+
+        if not restart or self.core is None or not self.core.started:
+            return {"asset": asset, "restart": None}
+
+        result = self.core.restart(self.core.config)
+        result["time_to_ready"] = self.wait_ready()
+        return {"asset": asset, "restart": result}
+
+    @rpyc.exposed
+    def fetch_metrics(self) -> str:
+        return REGISTRY.render()
+
+    @rpyc.exposed
+    @CALL_DURATION.time(method="batch")
+    def batch(self, operations: str, stop_on_error: bool = True) -> dict:
+        """
+        Runs operations in one call and in order, operations is a json list of {"method": name, "params": {...}}
+        returns every result as {"method", "result"} or {"method", "error": {"type", "message"}}
+        and the number of operations skipped after the first failure when stop_on_error is set
+        """
+        operations = json.loads(operations)
+        if not isinstance(operations, list):
+            raise ValueError("Operations must be a list")
+
+        results = []
+        for operation in operations:
+            method = operation.get('method') if isinstance(operation, dict) else None
+            try:
+                if not isinstance(operation, dict):
+                    raise TypeError("Operation must be an object")
+                if method not in BATCH_METHODS:
+                    raise LookupError(f'Unknown method "{method}"')
+                result = {"method": method, "result": getattr(self, method)(**(operation.get('params') or {}))}
+            except Exception as exc:
+                result = {"method": method, "error": {"type": type(exc).__name__, "message": str(exc)}}
+
+            results.append(result)
+            if "error" in result and stop_on_error:
+                break
+
+        return {
+            "results": results,
+            "skipped": len(operations) - len(results)
+        }
@@ -0,0 +1,73 @@
+import threading
+import time
+from uuid import uuid4
+
+from timeseries import TimeSeriesStore
+from xray_api import XRayAPI
+
+
+class StatsCollector(object):
+    """
+    Owns Xray's stats counters by querying them with reset and keeping running totals in memory
+    every poll that changes a counter bumps the cursor, so callers can ask only for what changed since their last cursor
+    """
+
+    def __init__(self, api: XRayAPI):
+        self.api = api
+        self.epoch = uuid4().hex
+        self.cursor = 0
+        self.totals = {}
+        self.history = TimeSeriesStore()
+
+        self._changed_at = {}
+        self._lock = threading.Lock()
+
+    def poll(self) -> dict:
+        """Queries and resets counters, returns the deltas of the ones that changed"""
+        with self._lock:
+            deltas = {name: value for name, value in self.api.query_stats(reset=True) if value}
+            if not deltas:
+                return deltas
+
+            self.cursor += 1
+            for name, value in deltas.items():
+                self.totals[name] = self.totals.get(name, 0) + value
+                self._changed_at[name] = self.cursor
+
+        self.history.add(time.time(), deltas)
+        return deltas
+
+    def peek(self, pattern: str = '') -> dict:
+        """
+        Returns counters matching the pattern without resetting them, so whoever polls Xray with reset keeps it's counts
+        values are the running totals plus what Xray has counted since the last poll
+        """
+        with self._lock:
+            return {name: self.totals.get(name, 0) + value for name, value in self.api.query_stats(pattern)}
+
+    def changes(self, cursor: int = 0) -> dict:
+        self.poll()
+
+        with self._lock:
+            if cursor > self.cursor:
+                cursor = 0
+
+            result = {
+                "epoch": self.epoch,
+                "cursor": self.cursor,
+                "users": {},
+                "inbounds": {},
+                "outbounds": {}
+            }
+            for name, changed_at in self._changed_at.items():
+                if changed_at <= cursor:
+                    continue
+
+                try:
+                    kind, key, _, link = name.split('>>>')
+                    group = result[f'{kind}s']
+                except (KeyError, ValueError):
+                    continue
+                group.setdefault(key, {})[link] = self.totals[name]
+
+        return result
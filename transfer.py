@@ -0,0 +1,119 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd bodies are only accepted when zstandard is installed
+    zstandard = None
+
+MAX_DECOMPRESSED_SIZE = 256 * 1024 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+class PayloadTooLargeError(ValueError):
+    pass
+
+
+def supported_encodings() -> list:
+    encodings = ['gzip', 'deflate']
+    if zstandard is not None:
+        encodings.append('zstd')
+    return encodings
+
+
+def decompress(data: bytes, encoding: str = None) -> bytes:
+    """
+    Decompresses data by it's content encoding, or by it's magic number if encoding isn't given
+    data without a known magic number is returned as is, raises ValueError if it can't be decompressed
+    """
+    if encoding is None:
+        if data[:2] == GZIP_MAGIC:
+            encoding = 'gzip'
+        elif data[:4] == ZSTD_MAGIC:
+            encoding = 'zstd'
+        else:
+            return data
+
+    encoding = encoding.strip().lower()
+    if encoding in ('', 'identity'):
+        return data
+
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        try:
+            # accepts both gzip and zlib headers
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+            result = decompressor.decompress(data, MAX_DECOMPRESSED_SIZE)
+        except zlib.error as exc:
+            raise ValueError(f"Invalid {encoding} data: {exc}")
+        if decompressor.unconsumed_tail:
+            raise PayloadTooLargeError(f"Decompressed data is larger than {MAX_DECOMPRESSED_SIZE} bytes")
+        return result
+
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd is not supported, zstandard is not installed")
+        chunks, size = [], 0
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+                while chunk := reader.read(1024 * 1024):
+                    size += len(chunk)
+                    if size > MAX_DECOMPRESSED_SIZE:
+                        raise PayloadTooLargeError(f"Decompressed data is larger than {MAX_DECOMPRESSED_SIZE} bytes")
+                    chunks.append(chunk)
+        except zstandard.ZstdError as exc:
+            raise ValueError(f"Invalid zstd data: {exc}")
+        return b''.join(chunks)
+
+    raise ValueError(f'Unsupported content encoding "{encoding}"')
+
+
+class DecompressMiddleware(object):
+    """ASGI middleware that decompresses request bodies sent with a Content-Encoding header"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        encoding = headers.get(b'content-encoding', b'').decode('latin-1')
+        if encoding.strip().lower() in ('', 'identity'):
+            return await self.app(scope, receive, send)
+
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] != "http.request":
+                return await self.app(scope, receive, send)
+            chunks.append(message.get("body", b''))
+            more_body = message.get("more_body", False)
+
+        try:
+            body = decompress(b''.join(chunks), encoding)
+        except ValueError as exc:
+            status = 413 if isinstance(exc, PayloadTooLargeError) else 415
+            await send({
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b'content-type', b'text/plain; charset=utf-8')]
+            })
+            return await send({"type": "http.response.body", "body": str(exc).encode()})
+
+        headers.pop(b'content-encoding')
+        headers[b'content-length'] = str(len(body)).encode()
+        scope = {**scope, "headers": list(headers.items())}
+
+        sent = False
+
+        async def receive_body():
+            nonlocal sent
+            if sent:
+                return await receive()
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        await self.app(scope, receive_body, send)
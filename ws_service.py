@@ -0,0 +1,359 @@
+import asyncio
+import functools
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import msgpack
+from fastapi import FastAPI, WebSocket
+from starlette.websockets import WebSocketDisconnect
+
+from config import (WS_HEARTBEAT_INTERVAL, XRAY_ASSETS_PATH,
+                    XRAY_EXECUTABLE_PATH, XRAY_START_TIMEOUT)
+from configpatch import PatchError
+from logfilter import LogFilter
+from logger import logger
+from metrics import REGISTRY, Histogram
+from transfer import decompress
+from xray import ConfigValidationError, XRayConfig, XRayCore
+
+app = FastAPI()
+
+REQUEST_DURATION = Histogram("marzban_node_ws_request_duration_seconds",
+                             "Seconds spent handling websocket requests", ("method",))
+
+
+class RequestError(Exception):
+    def __init__(self, code: int, message):
+        self.code = code
+        self.message = message
+        super().__init__(message)
+
+
+class Session(object):
+    """
+    A connected panel, every binary frame is a msgpack map
+    requests: {"id": int, "method": str, "params": {...}}
+    responses: {"id": int, "result": ...} or {"id": int, "error": {"code": int, "message": ...}},
+    sent as soon as each request completes so they may arrive out of order
+    pushes: {"type": "heartbeat" | "logs" | "stats", ...}
+    """
+
+    def __init__(self, service: "Service", websocket: WebSocket):
+        self.service = service
+        self.core = service.core
+        self.websocket = websocket
+        self.peer = websocket.client.host
+
+        self._send_lock = asyncio.Lock()
+        self._tasks = set()
+        self._subscriptions = {}
+
+        self.methods = {
+            "info": self.info,
+            "start": self.start,
+            "stop": self.stop,
+            "restart": self.restart,
+            "disconnect": self.disconnect,
+            "users": self.alter_users,
+            "stats": self.get_stats,
+            "stats_history": self.get_stats_history,
+            "access": self.get_access_summary,
+            "limits": self.set_user_limits,
+            "enforcement_events": self.get_enforcement_events,
+            "metrics": self.metrics,
+            "subscribe_logs": self.subscribe_logs,
+            "subscribe_stats": self.subscribe_stats,
+            "unsubscribe": self.unsubscribe
+        }
+
+    async def send(self, message: dict):
+        data = msgpack.packb(message, use_bin_type=True)
+        async with self._send_lock:
+            await self.websocket.send_bytes(data)
+
+    def info_message(self) -> dict:
+        return {
+            "started": self.core.started,
+            "core_version": self.service.core_version,
+            "config_hash": self.core.config.hash if self.core.config is not None else None
+        }
+
+    async def run(self):
+        self.spawn(self._heartbeat())
+        try:
+            while True:
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+
+                try:
+                    request = msgpack.unpackb(message.get("bytes") or b'', raw=False)
+                    request_id, method = request["id"], request["method"]
+                    params = request.get("params") or {}
+                except (ValueError, TypeError, KeyError, msgpack.UnpackException):
+                    await self.send({"id": None, "error": {"code": 400, "message": "Invalid request frame"}})
+                    continue
+
+                self.spawn(self.handle(request_id, method, params))
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+        finally:
+            for task in list(self._tasks):
+                task.cancel()
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def handle(self, request_id, method: str, params: dict):
+        func = self.methods.get(method)
+        start_time = time.perf_counter()
+        try:
+            if func is None:
+                raise RequestError(404, f'Unknown method "{method}"')
+            if not isinstance(params, dict):
+                raise RequestError(400, "Params must be a map")
+            try:
+                result = await func(**params)
+            except TypeError as exc:
+                raise RequestError(400, str(exc))
+            except ConfigValidationError as exc:
+                raise RequestError(422, {"config": str(exc)})
+            except (ValueError, PatchError) as exc:
+                raise RequestError(422, str(exc))
+            except (RuntimeError, TimeoutError, ProcessLookupError) as exc:
+                raise RequestError(503, str(exc))
+            response = {"id": request_id, "result": result}
+        except RequestError as exc:
+            response = {"id": request_id, "error": {"code": exc.code, "message": exc.message}}
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            # every request gets a response, even if it fails in a way the methods don't anticipate
+            logger.exception(f'Websocket method "{method}" failed')
+            response = {"id": request_id, "error": {"code": 500, "message": f"{type(exc).__name__}: {exc}"}}
+        finally:
+            if func is not None:
+                REQUEST_DURATION.observe(time.perf_counter() - start_time, method=method)
+
+        try:
+            await self.send(response)
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+
+    async def _heartbeat(self):
+        while True:
+            try:
+                await self.send({"type": "heartbeat", "ts": time.time(), **self.info_message()})
+            except (WebSocketDisconnect, RuntimeError):
+                return
+            await asyncio.sleep(WS_HEARTBEAT_INTERVAL)
+
+    async def run_in_thread(self, func: callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(func, *args))
+
+    def load_config(self, config=None, base_hash: str = None, patch=None) -> XRayConfig:
+        if patch is None:
+            if config is None:
+                raise ValueError("Either config or patch must be given")
+            if isinstance(config, bytes):
+                config = decompress(config)
+            return XRayConfig.load(config, self.peer, self.core.config)
+
+        current = self.core.config
+        if current is None or current.hash != base_hash:
+            raise RequestError(409, {
+                "config": "Base config hash doesn't match the current one, send the whole config",
+                "config_hash": current.hash if current is not None else None
+            })
+        if isinstance(patch, bytes):
+            patch = json.loads(decompress(patch))
+        return current.patch(patch, self.peer)
+
+    def wait_ready(self):
+        try:
+            return self.core.wait_ready(XRAY_START_TIMEOUT)
+        except TimeoutError as exc:
+            if not self.core.started:
+                raise RuntimeError(str(exc))
+            logger.warning(f"{exc}, core is still running though")
+
+    async def info(self):
+        return {**self.info_message(), **self.core.supervisor_stats}
+
+    async def start(self, config=None, base_hash: str = None, patch=None):
+        def start():
+            new_config = self.load_config(config, base_hash, patch)
+            self.core.start(new_config)
+            return {"time_to_ready": self.wait_ready(), **self.info_message()}
+
+        return await self.service.core_operation(start)
+
+    async def stop(self):
+        await self.service.core_operation(self.service.stop_core)
+        return self.info_message()
+
+    async def restart(self, config=None, base_hash: str = None, patch=None):
+        def restart():
+            new_config = self.load_config(config, base_hash, patch)
+            start_time = time.time()
+            result = self.core.update(new_config)
+            time_to_ready = self.wait_ready() if result["strategy"] == 'restart' else 0
+            return {
+                **result,
+                **self.info_message(),
+                "duration": round(time.time() - start_time, 3),
+                "time_to_ready": time_to_ready
+            }
+
+        return await self.service.core_operation(restart)
+
+    async def disconnect(self):
+        """Stops the core, a dropped connection leaves it running so the panel can reconnect and resume"""
+        await self.service.core_operation(self.service.stop_core)
+        return self.info_message()
+
+    async def alter_users(self, inbounds: dict):
+        if not isinstance(inbounds, dict):
+            raise RequestError(400, "Inbounds must be a map of inbound tags to changes")
+        return await self.service.core_operation(self.core.alter_users, inbounds)
+
+    async def get_stats(self, cursor: int = 0):
+        return await self.run_in_thread(self.core.get_stats, cursor)
+
+    async def get_stats_history(self, users: list = (), inbounds: list = (),
+                                start: float = 0, end: float = None, resolution: int = None):
+        return await self.run_in_thread(self.core.get_stats_history, users, inbounds, start, end, resolution)
+
+    async def get_access_summary(self, limit: int = 20):
+        return self.core.get_access_summary(limit)
+
+    async def set_user_limits(self, limits: dict, replace: bool = False):
+        if not isinstance(limits, dict):
+            raise RequestError(400, "Limits must be a map of emails to limits")
+        return self.core.set_user_limits(limits, replace)
+
+    async def get_enforcement_events(self, after: int = 0, limit: int = 1000):
+        return self.core.get_enforcement_events(after, limit)
+
+    async def metrics(self):
+        return REGISTRY.render()
+
+    def subscribe(self, name: str, coroutine):
+        self.unsubscribe_now(name)
+        self._subscriptions[name] = self.spawn(coroutine)
+
+    def unsubscribe_now(self, name: str) -> bool:
+        task = self._subscriptions.pop(name, None)
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+    async def unsubscribe(self, name: str):
+        return {"unsubscribed": self.unsubscribe_now(name)}
+
+    async def subscribe_logs(self, since: int = None, interval: float = 0.5, limit: int = 1000, **filters):
+        """Pushes {"type": "logs", "seq", "next", "lines", "missed"?, "dropped"?} batches at most every interval"""
+        log_filter = LogFilter(**filters) if filters else None
+        if not 0 <= interval <= 10:
+            raise ValueError("Interval must be at least 0 and at most 10 seconds")
+
+        async def push():
+            with self.core.get_logs(since, log_filter) as logs:
+                while True:
+                    await logs.wait_async(WS_HEARTBEAT_INTERVAL)
+                    seq, lines, missed = logs.read(limit)
+                    dropped = log_filter.take_rate_limited() if log_filter else 0
+                    if lines or missed or dropped:
+                        message = {"type": "logs", "seq": seq, "next": logs.cursor, "lines": lines}
+                        if missed:
+                            message["missed"] = missed
+                        if dropped:
+                            message["dropped"] = dropped
+                        try:
+                            await self.send(message)
+                        except (WebSocketDisconnect, RuntimeError):
+                            return
+                    if interval and not logs:
+                        await asyncio.sleep(interval)
+
+        self.subscribe("logs", push())
+        return {"next": self.core.logs.next_seq}
+
+    async def subscribe_stats(self, cursor: int = 0, interval: float = 10):
+        """Pushes {"type": "stats", ...} with the counters changed since the last push every interval seconds"""
+        if interval < 1:
+            raise ValueError("Interval must be at least 1 second")
+
+        async def push():
+            nonlocal cursor
+            while True:
+                if self.core.started:
+                    try:
+                        changes = await self.run_in_thread(self.core.get_stats, cursor)
+                    except RuntimeError as exc:
+                        logger.debug(f"Failed to push stats: {exc}")
+                    else:
+                        if changes["cursor"] != cursor:
+                            cursor = changes["cursor"]
+                            try:
+                                await self.send({"type": "stats", **changes})
+                            except (WebSocketDisconnect, RuntimeError):
+                                return
+                await asyncio.sleep(interval)
+
+        self.subscribe("stats", push())
+        return {}
+
+
+class Service(object):
+    """Serves the panel over a single websocket, a new connection takes control from the previous one"""
+
+    def __init__(self):
+        self.core = XRayCore(
+            executable_path=XRAY_EXECUTABLE_PATH,
+            assets_path=XRAY_ASSETS_PATH
+        )
+        self.core_version = self.core.version
+        self.session = None
+        self._core_operations = ThreadPoolExecutor(max_workers=1, thread_name_prefix='core-operations')
+
+    async def core_operation(self, func: callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._core_operations, functools.partial(func, *args))
+
+    def stop_core(self):
+        try:
+            self.core.stop()
+        except RuntimeError:
+            pass
+
+    async def connect(self, websocket: WebSocket):
+        await websocket.accept()
+
+        previous, self.session = self.session, Session(self, websocket)
+        if previous is not None:
+            logger.warning(
+                f'New connection from {self.session.peer}, Core control access was taken away from previous client.')
+            try:
+                await previous.websocket.close(code=4409, reason="Another client connected.")
+            except RuntimeError:
+                pass
+        logger.info(f'{self.session.peer} connected')
+
+        session = self.session
+        try:
+            await session.run()
+        finally:
+            if self.session is session:
+                self.session = None
+                logger.info(f'{session.peer} disconnected')
+
+
+service = Service()
+app.add_api_websocket_route("/", service.connect)
@@ -1,23 +1,144 @@
 import atexit
+import copy
+import hashlib
 import json
+import os
 import re
+import selectors
+import socket
+import ssl
 import subprocess
 import threading
-from collections import deque
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
-from config import DEBUG, SSL_CERT_FILE, SSL_KEY_FILE, XRAY_API_HOST, XRAY_API_PORT
+try:
+    import orjson
+except ImportError:  # configs are compiled with the stdlib json module when orjson isn't installed
+    orjson = None
+
+from accesslog import AccessAggregator
+from config import (ACCESS_LOG_AGGREGATION, DEBUG, ENFORCEMENT_INTERVAL,
+                    LOG_BUFFER_SIZE, LOG_SPOOL_MAX_AGE, LOG_SPOOL_MAX_SIZE,
+                    LOG_SPOOL_PATH, LOG_SPOOL_SEGMENT_SIZE, SSL_CERT_FILE, SSL_KEY_FILE,
+                    STATS_SAMPLE_INTERVAL, XRAY_API_HOST, XRAY_API_PORT, XRAY_AUTO_RECOVER,
+                    XRAY_DRAIN_TIMEOUT, XRAY_RECOVERY_BACKOFF,
+                    XRAY_RECOVERY_BACKOFF_MAX, XRAY_RESTART_MODE,
+                    XRAY_HOOK_WORKERS, XRAY_START_TIMEOUT, XRAY_STOP_TIMEOUT,
+                    XRAY_VALIDATE_CONFIG, XRAY_VALIDATION_TIMEOUT,
+                    XRAY_VALIDATION_WORKERS)
+from configpatch import PatchError, apply_patch
+from enforcement import Enforcer
+from logbus import LogBus
+from logfilter import LogFilter
 from logger import logger
+from logspool import LogSpool
+from metrics import REGISTRY, Counter, Histogram, sample_process
+from stats import StatsCollector
+from xray_api import (EmailExistsError, EmailNotFoundError, XRayAPI,
+                      XRayAPIError, build_account)
+
+LOG_CHUNK_SIZE = 64 * 1024
+API_PROBE_INTERVAL = 0.1
+SERIALIZED_CACHE_SIZE = 4
+VALIDATION_CACHE_SIZE = 64
+
+LOG_LINES = Counter("marzban_node_log_lines_total",
+                    "Lines captured from Xray's stdout and stderr")
+TIME_TO_READY = Histogram("marzban_node_xray_time_to_ready_seconds",
+                          "Seconds between spawning Xray and it getting ready")
+RESTART_DURATION = Histogram("marzban_node_xray_restart_duration_seconds",
+                             "Seconds spent restarting Xray", ("mode",))
+CONFIG_UPDATES = Counter("marzban_node_config_updates_total",
+                         "Configs applied, by the strategy used", ("strategy",))
+CONFIG_VALIDATIONS = Counter("marzban_node_config_validations_total",
+                             "Configs tested before restarts, by the result", ("result",))
+
+
+class ConfigValidationError(ValueError):
+    pass
+
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def canonical_json(obj) -> bytes:
+    """
+    Serializes with sorted keys and the stdlib json module whatever backend is installed,
+    backends format floats and non-ASCII text differently and hashes must match the panel's and other nodes'
+    """
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8', 'surrogatepass')
+
+
+def raw_digest(data) -> str:
+    return hashlib.sha256(data.encode('utf-8', 'surrogatepass') if isinstance(data, str) else data).hexdigest()
+
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def get_xray_version(executable_path: str):
+    """Returns the version of an Xray executable, it's only run once per path, modification time and size"""
+    path = os.path.realpath(executable_path)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+
+    with _versions_lock:
+        if key in _versions:
+            return _versions[key]
+
+        cmd = [executable_path, "version"]
+        output = subprocess.check_output(
+            cmd, stderr=subprocess.STDOUT).decode('utf-8')
+        m = re.match(r'^Xray (\d+\.\d+\.\d+)', output)
+        version = m.groups()[0] if m else None
+
+        # drop versions of replaced executables at the same path
+        for old_key in [k for k in _versions if k[0] == path]:
+            del _versions[old_key]
+        _versions[key] = version
+        return version
 
 
 class XRayConfig(dict):
     """
     Loads Xray config json
     config must contain an inbound with the API_INBOUND tag name which handles API requests
+    hash is the sha256 of the config's canonical form (see canonical_json) before the node's settings are applied,
+    panels send patches against it instead of the whole config
     """
 
-    def __init__(self, config: str, peer_ip: str):
-        config = json.loads(config)
+    # serialized configs of recently compiled sources, keyed by (hash, peer_ip)
+    _serialized_cache = OrderedDict()
+    _serialized_lock = threading.Lock()
+
+    def __init__(self, config, peer_ip: str, raw_hash: str = None):
+        # sha256 of the json the config was compiled from, an identical resend is recognized by it before parsing
+        self._raw_key = None
+        if not isinstance(config, dict):
+            self._raw_key = (raw_hash or raw_digest(config), peer_ip)
+            config = json_loads(config)
+
+        # canonical form of the config before the node's settings are applied to it
+        self._source = canonical_json(config)
+        self._hash = hashlib.sha256(self._source).hexdigest()
+        # client changes made through the API since, replayed on the source once it's read again
+        self._client_changes = []
+        self._source_lock = threading.Lock()
+        # cleared once clients are altered, the config no longer matches it's source then
+        self._serialized_key = (self._hash, peer_ip)
 
         self.api_host = XRAY_API_HOST
         self.api_port = XRAY_API_PORT
@@ -28,18 +149,158 @@ class XRayConfig(dict):
         super().__init__(config)
         self._apply_api()
 
+        if self.get('log', {}).get('logLevel') in ('none', 'error'):
+            self['log']['logLevel'] = 'warning'
+
+    @classmethod
+    def load(cls, config, peer_ip: str, current: "XRayConfig" = None) -> "XRayConfig":
+        """
+        Compiles the config unless it's the very json the current one was compiled from for the same peer,
+        that one is returned as is while it's clients are unaltered, so an unchanged resend isn't parsed at all
+        """
+        if isinstance(config, dict):
+            return cls(config, peer_ip)
+
+        raw_hash = raw_digest(config)
+        if current is not None and current._serialized_key is not None and current._raw_key == (raw_hash, peer_ip):
+            return current
+        return cls(config, peer_ip, raw_hash)
+
+    @property
+    def source(self) -> bytes:
+        with self._source_lock:
+            if self._client_changes:
+                self._replay_client_changes()
+            return self._source
+
+    @property
+    def hash(self) -> str:
+        with self._source_lock:
+            if self._client_changes:
+                self._replay_client_changes()
+            return self._hash
+
+    def _replay_client_changes(self):
+        """Applies the clients altered on the compiled config to the source, so hash and patches follow them"""
+        config = json_loads(self._source)
+        inbounds = {inbound.get('tag'): inbound for inbound in config.get('inbounds', [])}
+        for tag, email, client in self._client_changes:
+            inbound = inbounds.get(tag)
+            if inbound is None:
+                continue
+            clients = inbound.setdefault('settings', {}).setdefault('clients', [])
+            clients[:] = [c for c in clients if c.get('email') != email]
+            if client is not None:
+                clients.append(client)
+
+        self._client_changes = []
+        self._source = canonical_json(config)
+        self._hash = hashlib.sha256(self._source).hexdigest()
+
     def to_json(self, **json_kwargs):
-        return json.dumps(self, **json_kwargs)
+        if json_kwargs:
+            return json.dumps(self, **json_kwargs)
+        return self.to_bytes().decode()
 
-    def _apply_api(self):
+    def to_bytes(self) -> bytes:
+        """Serializes the config, reusing the result of an earlier config with the same source while unaltered"""
+        cache = self._serialized_cache
+        key = self._serialized_key
+        if key is None:
+            return json_dumps(self)
+
+        with self._serialized_lock:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+
+        data = json_dumps(self)
+        with self._serialized_lock:
+            cache[key] = data
+            while len(cache) > SERIALIZED_CACHE_SIZE:
+                cache.popitem(last=False)
+        return data
+
+    def patch(self, patch: list, peer_ip: str) -> "XRayConfig":
+        """Returns a new config built by applying a JSON patch to the source of this one"""
+        config = apply_patch(json_loads(self.source), patch)
+        if not isinstance(config, dict):
+            raise PatchError("Patched config must be an object")
+        return XRayConfig(config, peer_ip)
+
+    def _structure(self) -> dict:
+        """Returns the config with clients stripped out of the inbounds"""
+        inbounds = []
         for inbound in self.get('inbounds', []):
-            if inbound.get('protocol') == 'dokodemo-door' and inbound.get('tag') == 'API_INBOUND':
-                self['inbounds'].remove(inbound)
+            settings = inbound.get('settings')
+            if isinstance(settings, dict) and 'clients' in settings:
+                settings = {k: v for k, v in settings.items() if k != 'clients'}
+                inbound = {**inbound, 'settings': settings}
+            inbounds.append(inbound)
+        return {**self, 'inbounds': inbounds}
+
+    def diff(self, other: "XRayConfig"):
+        """
+        Compares the config with another one
+        returns None if they differ structurally, otherwise the client changes per inbound tag
+        in the format XRayCore.alter_users accepts (empty if configs are identical)
+        """
+        if self._serialized_key is not None and self._serialized_key == other._serialized_key:
+            # same source compiled for the same peer and neither has been altered since
+            return {}
+
+        if self == other:
+            return {}
+
+        if self._structure() != other._structure():
+            return None
+
+        changes = {}
+        for inbound in other.get('inbounds', []):
+            tag = inbound.get('tag')
+            old_clients = self.get_inbound(tag).get('settings', {}).get('clients', [])
+            new_clients = inbound.get('settings', {}).get('clients', [])
+            if old_clients == new_clients:
+                continue
+
+            old = {c.get('email'): c for c in old_clients}
+            new = {c.get('email'): c for c in new_clients}
+            if None in old or None in new or len(old) != len(old_clients) or len(new) != len(new_clients):
+                # clients can only be altered through the API by their unique email
+                return None
 
-        for rule in self.get('routing', {}).get("rules", []):
-            api_tag = self.get('api', {}).get('tag')
-            if api_tag and rule.get('outboundTag') == api_tag:
-                self['routing']['rules'].remove(rule)
+            remove = [email for email, client in old.items() if new.get(email) != client]
+            add = [client for email, client in new.items() if old.get(email) != client]
+            if remove or add:
+                changes[tag] = {"add": add, "remove": remove}
+
+        return changes
+
+    def get_inbound(self, tag: str):
+        for inbound in self.get('inbounds', []):
+            if inbound.get('tag') == tag:
+                return inbound
+
+    def add_client(self, tag: str, client: dict):
+        self._serialized_key = None
+        inbound = self.get_inbound(tag)
+        clients = inbound.setdefault('settings', {}).setdefault('clients', [])
+        clients[:] = [c for c in clients if c.get('email') != client['email']]
+        clients.append(client)
+        with self._source_lock:
+            self._client_changes.append((tag, client['email'], copy.deepcopy(client)))
+
+    def remove_client(self, tag: str, email: str):
+        self._serialized_key = None
+        inbound = self.get_inbound(tag)
+        clients = inbound.get('settings', {}).get('clients')
+        if clients:
+            clients[:] = [c for c in clients if c.get('email') != email]
+            with self._source_lock:
+                self._client_changes.append((tag, email, None))
+
+    def _apply_api(self):
+        api_tag = self.get('api', {}).get('tag')
 
         self["api"] = {
             "services": [
@@ -70,11 +331,11 @@ class XRayConfig(dict):
             },
             "tag": "API_INBOUND"
         }
-        try:
-            self["inbounds"].insert(0, inbound)
-        except KeyError:
-            self["inbounds"] = []
-            self["inbounds"].insert(0, inbound)
+        # rebuild the lists in one pass, removing from a list while iterating over it skips items
+        self["inbounds"] = [inbound] + [
+            i for i in self.get('inbounds') or []
+            if not (i.get('protocol') == 'dokodemo-door' and i.get('tag') == 'API_INBOUND')
+        ]
 
         rule = {
             "inboundTag": [
@@ -87,85 +348,321 @@ class XRayConfig(dict):
             "outboundTag": "API",
             "type": "field"
         }
+        routing = self.get('routing')
+        if not isinstance(routing, dict):
+            routing = self["routing"] = {}
+        routing["rules"] = [rule] + [
+            r for r in routing.get('rules') or []
+            if not (api_tag and r.get('outboundTag') == api_tag)
+        ]
+
+
+class Readiness(object):
+    """Tracks whether a spawned core process got ready or exited"""
+
+    def __init__(self):
+        self.ready = False
+        self.exited = False
+        self.created_at = time.monotonic()
+        self.ready_at = None
+        self.observed = False
+        self._condition = threading.Condition()
+
+    def set(self, ready: bool = False, exited: bool = False):
+        with self._condition:
+            if ready and not self.ready:
+                self.ready = True
+                self.ready_at = time.monotonic()
+            self.exited |= exited
+            self._condition.notify_all()
+
+    def wait(self, timeout: float = None) -> bool:
+        with self._condition:
+            return self._condition.wait_for(lambda: self.ready or self.exited, timeout)
+
+
+class ConfigValidator(object):
+    """
+    Tests configs with `xray run -test` in a small worker pool, results are cached by executable and config
+    so identical or repeated pushes are only tested once, concurrent tests of the same config share one run
+    """
+
+    def __init__(self, workers: int = 2, timeout: float = 10, cache_size: int = VALIDATION_CACHE_SIZE):
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='xray-validate')
+        self._cache = OrderedDict()
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """Drops cached results, they only hold for the assets the configs were tested with"""
+        with self._lock:
+            self._cache.clear()
+
+    def _test(self, cmd: list, env: dict, data: bytes):
         try:
-            self["routing"]["rules"].insert(0, rule)
-        except KeyError:
-            self["routing"] = {"rules": []}
-            self["routing"]["rules"].insert(0, rule)
+            result = subprocess.run(cmd, input=data, env=env, timeout=self.timeout,
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except subprocess.TimeoutExpired:
+            return None
+        except OSError as exc:
+            return False, str(exc)
+
+        if result.returncode == 0:
+            return True, None
+        lines = [line for line in result.stdout.decode('utf-8', 'replace').splitlines() if line.strip()]
+        return False, '\n'.join(lines[-5:]) or f"Xray exited with code {result.returncode}"
+
+    def validate(self, core: "XRayCore", config: XRayConfig) -> dict:
+        """Raises ConfigValidationError if the config is rejected and TimeoutError if it can't be tested in time"""
+        data = config.to_bytes()
+        key = (core.executable_path, core.version, config._serialized_key or hashlib.sha256(data).hexdigest())
+
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+            else:
+                future = self._running.get(key)
+                if future is None:
+                    cmd = [core.executable_path, "run", "-test", "-config", "stdin:"]
+                    future = self._running[key] = self._pool.submit(self._test, cmd, core._env, data)
+
+        if cached is not None:
+            CONFIG_VALIDATIONS.inc(result="cached")
+            valid, error = cached
+            if not valid:
+                raise ConfigValidationError(f"Config is invalid: {error}")
+            return {"cached": True, "duration": 0}
+
+        start_time = time.perf_counter()
+        try:
+            result = future.result()
+        finally:
+            with self._lock:
+                self._running.pop(key, None)
+        duration = round(time.perf_counter() - start_time, 3)
+
+        if result is None:
+            CONFIG_VALIDATIONS.inc(result="timeout")
+            raise TimeoutError(f"Config test didn't finish in {self.timeout} seconds")
+
+        with self._lock:
+            self._cache[key] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        valid, error = result
+        CONFIG_VALIDATIONS.inc(result="valid" if valid else "invalid")
+        if not valid:
+            raise ConfigValidationError(f"Config is invalid: {error}")
+        return {"cached": False, "duration": duration}
+
+
+VALIDATOR = ConfigValidator(XRAY_VALIDATION_WORKERS, XRAY_VALIDATION_TIMEOUT)
+
+# on_start and on_stop hooks of every core run here instead of a thread each
+HOOKS_EXECUTOR = ThreadPoolExecutor(max_workers=XRAY_HOOK_WORKERS, thread_name_prefix='core-hooks')
+
+# shared by every core, the rpyc service creates a new core on each start
+LOG_SPOOL = LogSpool(LOG_SPOOL_PATH,
+                     segment_size=LOG_SPOOL_SEGMENT_SIZE,
+                     max_size=LOG_SPOOL_MAX_SIZE,
+                     max_age=LOG_SPOOL_MAX_AGE) if LOG_SPOOL_PATH else None
+
+
+def _log_hook_error(future):
+    exc = future.exception()
+    if exc is not None:
+        logger.error(f"Core hook failed: {exc}")
 
 
 class XRayCore:
     def __init__(self,
                  executable_path: str = "/usr/bin/xray",
-                 assets_path: str = "/usr/share/xray"):
+                 assets_path: str = "/usr/share/xray",
+                 enforcer: Enforcer = None):
         self.executable_path = executable_path
         self.assets_path = assets_path
 
         self.version = self.get_version()
         self.process = None
+        self.config = None
         self.restarting = False
+        self._readiness = None
+        self._draining = set()
+        self._lock = threading.RLock()
+
+        self.crashes = 0
+        self.last_recovery_time = None
+        self._recovery_backoff = XRAY_RECOVERY_BACKOFF
+
+        api_host = XRAY_API_HOST
+        if api_host in ('0.0.0.0', '::', ''):
+            api_host = '127.0.0.1'
+        self.api = XRayAPI(api_host, XRAY_API_PORT, SSL_CERT_FILE)
+        self.stats = StatsCollector(self.api)
+        self.access = AccessAggregator() if ACCESS_LOG_AGGREGATION else None
+        # an enforcer handed over from a replaced core keeps enforcing it's limits on this one
+        self.enforcer = enforcer if enforcer is not None else Enforcer(interval=ENFORCEMENT_INTERVAL)
+        self.enforcer.attach(self)
 
-        self._logs_buffer = deque(maxlen=100)
-        self._temp_log_buffers = {}
+        self.logs = LogBus(backlog=100, max_bytes=LOG_BUFFER_SIZE)
+        self.spool = LOG_SPOOL
         self._on_start_funcs = []
         self._on_stop_funcs = []
         self._env = {
             "XRAY_LOCATION_ASSET": assets_path
         }
 
-        atexit.register(lambda: self.stop() if self.started else None)
+        self._stop_at_exit = lambda: self.stop() if self.started else None
+        atexit.register(self._stop_at_exit)
+        REGISTRY.set_collector('xray', self._collect_metrics)
 
     def get_version(self):
-        cmd = [self.executable_path, "version"]
-        output = subprocess.check_output(
-            cmd, stderr=subprocess.STDOUT).decode('utf-8')
-        m = re.match(r'^Xray (\d+\.\d+\.\d+)', output)
-        if m:
-            return m.groups()[0]
-
-    def __capture_process_logs(self):
-        def capture_and_debug_log():
-            while self.process:
-                output = self.process.stdout.readline()
-                if output:
-                    output = output.strip()
-                    self._logs_buffer.append(output)
-                    for buf in list(self._temp_log_buffers.values()):
-                        buf.append(output)
-                    logger.debug(output)
-
-                elif not self.process or self.process.poll() is not None:
-                    break
+        return get_xray_version(self.executable_path)
+
+    def __capture_process_logs(self, process: subprocess.Popen, readiness: "Readiness"):
+        def capture():
+            started_line = f'Xray {self.version} started'
+            pending = {}
+            with selectors.DefaultSelector() as selector:
+                for pipe in (process.stdout, process.stderr):
+                    selector.register(pipe, selectors.EVENT_READ)
+                    pending[pipe.fileno()] = b''
 
-        def capture_only():
-            while self.process:
-                output = self.process.stdout.readline()
-                if output:
-                    output = output.strip()
-                    self._logs_buffer.append(output)
-                    for buf in list(self._temp_log_buffers.values()):
-                        buf.append(output)
+                while selector.get_map():
+                    batch = []
+                    for key, _ in selector.select():
+                        chunk = os.read(key.fd, LOG_CHUNK_SIZE)
+                        if not chunk:
+                            selector.unregister(key.fileobj)
+                            chunk, pending[key.fd] = pending[key.fd] + b'\n', b''
+                        else:
+                            chunk = pending[key.fd] + chunk
 
-                elif not self.process or self.process.poll() is not None:
+                        end = chunk.rfind(b'\n')
+                        if end == -1:
+                            if len(chunk) < LOG_CHUNK_SIZE:
+                                pending[key.fd] = chunk
+                                continue
+                            end = len(chunk)
+
+                        pending[key.fd] = chunk[end + 1:]
+                        batch.extend(
+                            line for line in map(str.strip, chunk[:end].decode('utf-8', 'replace').split('\n'))
+                            if line
+                        )
+
+                    self.logs.publish(batch)
+                    if self.spool is not None:
+                        self.spool.append(batch)
+                    LOG_LINES.inc(len(batch))
+                    if not readiness.ready and any(started_line in line for line in batch):
+                        readiness.set(ready=True)
+                    if DEBUG:
+                        for line in batch:
+                            logger.debug(line)
+
+            process.stdout.close()
+            process.stderr.close()
+            readiness.set(exited=True)
+
+        threading.Thread(target=capture, daemon=True).start()
+
+    def __sample_stats(self, process: subprocess.Popen):
+        def sample():
+            while True:
+                time.sleep(STATS_SAMPLE_INTERVAL)
+                if self.process is not process or process.poll() is not None:
                     break
+                try:
+                    self.stats.poll()
+                except XRayAPIError as exc:
+                    logger.debug(f"Failed to sample stats: {exc}")
+
+        threading.Thread(target=sample, daemon=True).start()
+
+    def __aggregate_access_logs(self, process: subprocess.Popen):
+        def aggregate():
+            with self.logs.subscribe(since=self.logs.next_seq) as logs:
+                while self.process is process or logs:
+                    if logs.wait(1):
+                        self.access.add_lines(logs.drain())
+
+        threading.Thread(target=aggregate, daemon=True).start()
+
+    def __supervise(self, process: subprocess.Popen, readiness: Readiness):
+        def supervise():
+            nonlocal process
+            returncode = process.wait()
+            # let log capture drain, a started line printed right before exiting still counts
+            readiness.wait()
+            if self.process is not process:
+                # stopped or replaced on purpose
+                return
+
+            if not readiness.ready and time.monotonic() - readiness.created_at < XRAY_START_TIMEOUT:
+                # a failed start is reported to whoever started it (or the recovery below), it's not a crash
+                logger.error(f"Xray core exited with code {returncode} before getting ready")
+                self._run_hooks(self._on_stop_funcs)
+                return
+
+            self.crashes += 1
+            crashed_at = time.monotonic()
+            logger.error(f"Xray core exited unexpectedly with code {returncode}")
+
+            # execute on stop functions
+            self._run_hooks(self._on_stop_funcs)
 
-        if DEBUG:
-            threading.Thread(target=capture_and_debug_log).start()
-        else:
-            threading.Thread(target=capture_only).start()
+            if not XRAY_AUTO_RECOVER:
+                return
+
+            # back off exponentially while the core keeps crashing shortly after being started
+            if crashed_at - readiness.created_at > XRAY_RECOVERY_BACKOFF_MAX:
+                self._recovery_backoff = XRAY_RECOVERY_BACKOFF
+
+            while True:
+                delay = self._recovery_backoff
+                self._recovery_backoff = min(delay * 2, XRAY_RECOVERY_BACKOFF_MAX)
+                time.sleep(delay)
+
+                with self._lock:
+                    if self.process is not process or self.config is None:
+                        return
+                    self.process = None
+                    try:
+                        self.start(self.config)
+                    except Exception as exc:
+                        self.process = process
+                        logger.error(f"Failed to recover Xray core: {exc}")
+                        continue
+                    # a crash of the new process after it got ready is handled by it's own supervisor
+                    process = self.process
+
+                try:
+                    self.wait_ready()
+                except TimeoutError:
+                    pass
+                except RuntimeError as exc:
+                    # exited before getting ready, try again after the next delay
+                    logger.error(f"Failed to recover Xray core: {exc}")
+                    continue
+
+                self.last_recovery_time = round(time.monotonic() - crashed_at, 3)
+                logger.warning(f"Xray core recovered in {self.last_recovery_time} seconds")
+                return
+
+        threading.Thread(target=supervise, daemon=True).start()
 
     @contextmanager
-    def get_logs(self):
-        buf = deque(self._logs_buffer, maxlen=100)
-        buf_id = id(buf)
-        try:
-            self._temp_log_buffers[buf_id] = buf
-            yield buf
-        except (EOFError, TimeoutError):
-            pass
-        finally:
-            del self._temp_log_buffers[buf_id]
-            del buf
+    def get_logs(self, since: int = None, log_filter: LogFilter = None):
+        with self.logs.subscribe(since, log_filter) as subscriber:
+            try:
+                yield subscriber
+            except (EOFError, TimeoutError):
+                pass
 
     @property
     def started(self):
@@ -177,60 +674,378 @@ class XRayCore:
 
         return False
 
-    def start(self, config: XRayConfig):
-        if self.started is True:
-            raise RuntimeError("Xray is started already")
-
-        if config.get('log', {}).get('logLevel') in ('none', 'error'):
-            config['log']['logLevel'] = 'warning'
-
+    def _spawn(self, config: XRayConfig):
         cmd = [
             self.executable_path,
             "run",
             '-config',
             'stdin:'
         ]
-        self.process = subprocess.Popen(
+        process = subprocess.Popen(
             cmd,
             env=self._env,
             stdin=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            universal_newlines=True
+            stdout=subprocess.PIPE
         )
-        self.process.stdin.write(config.to_json())
-        self.process.stdin.flush()
-        self.process.stdin.close()
+        process.stdin.write(config.to_bytes())
+        process.stdin.flush()
+        process.stdin.close()
 
-        self.__capture_process_logs()
+        readiness = Readiness()
+        self.__capture_process_logs(process, readiness)
+        return process, readiness
+
+    def _adopt(self, process: subprocess.Popen, readiness: Readiness, config: XRayConfig):
+        self.process, self._readiness = process, readiness
+        self.config = config
+        self.__supervise(process, readiness)
+        if STATS_SAMPLE_INTERVAL > 0:
+            self.__sample_stats(process)
+        if self.access is not None:
+            self.__aggregate_access_logs(process)
+
+        self.enforcer.start()
 
         # execute on start functions
-        for func in self._on_start_funcs:
-            threading.Thread(target=func).start()
+        self._run_hooks(self._on_start_funcs)
+
+    def start(self, config: XRayConfig):
+        with self._lock:
+            if self.started is True:
+                raise RuntimeError("Xray is started already")
+
+            self._adopt(*self._spawn(config), config)
 
     def stop(self):
-        if not self.started:
-            return
+        with self._lock:
+            for process in list(self._draining):
+                self._terminate(process)
 
-        self.process.terminate()
-        self.process = None
-        logger.warning("Xray core stopped")
+            process, self.process = self.process, None
+            if process is None or process.poll() is not None:
+                return
 
-        # execute on stop functions
-        for func in self._on_stop_funcs:
-            threading.Thread(target=func).start()
+            self._terminate(process)
+            logger.warning("Xray core stopped")
 
-    def restart(self, config: XRayConfig):
-        if self.restarting is True:
+            # execute on stop functions
+            self._run_hooks(self._on_stop_funcs)
+
+    def close(self):
+        """
+        Stops the core and releases what it holds outside of itself, the API channel, the exit hook
+        and the metrics collector, for a core being replaced by a new one
+        """
+        self.stop()
+        self.api.close()
+        atexit.unregister(self._stop_at_exit)
+        REGISTRY.remove_collector('xray', self._collect_metrics)
+
+    def _terminate(self, process: subprocess.Popen):
+        """Terminates the process and kills it if it doesn't exit in XRAY_STOP_TIMEOUT seconds"""
+        self._draining.discard(process)
+        if process.poll() is not None:
             return
 
-        self.restarting = True
+        process.terminate()
+        try:
+            process.wait(XRAY_STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Xray core did not exit in {XRAY_STOP_TIMEOUT} seconds, killing it")
+            process.kill()
+            process.wait()
+
+    def _swap(self, config: XRayConfig) -> dict:
+        """
+        Starts a new process alongside the running one and switches to it once it's ready,
+        the old process keeps serving it's connections for XRAY_DRAIN_TIMEOUT seconds before being terminated.
+        Xray sets SO_REUSEPORT on it's listeners so both processes can bind the same ports,
+        if the new one can't (or fails for any other reason) falls back to a plain stop and start
+        the API port must only reach the new process, or users added or removed while the old one drains
+        would be lost with it, so the old process' API inbound is removed before the new one is spawned
+        """
         try:
-            logger.warning("Restarting Xray core...")
+            self.api.remove_inbound('API_INBOUND')
+        except XRayAPIError as exc:
+            logger.warning(f"Failed to close the API of the running core, falling back to stop and start: "
+                           f"{exc.details}")
             self.stop()
             self.start(config)
+            return {"mode": "overlap", "fallback": True, "overlap": 0}
+        finally:
+            # the channel is connected to the old process, the next call connects to the new one
+            self.api.close()
+
+        process, readiness = self._spawn(config)
+        try:
+            self._wait(readiness, XRAY_START_TIMEOUT, probe=False)
+        except (RuntimeError, TimeoutError) as exc:
+            logger.warning(f"Overlapping restart failed, falling back to stop and start: {exc}")
+            self._terminate(process)
+            self.stop()
+            self.start(config)
+            return {"mode": "overlap", "fallback": True, "overlap": 0}
+
+        old_process = self.process
+        self._draining.add(old_process)
+        self._adopt(process, readiness, config)
+
+        timer = threading.Timer(XRAY_DRAIN_TIMEOUT, self._terminate, args=(old_process,))
+        timer.daemon = True
+        timer.start()
+        logger.warning(f"Switched to the new Xray core, draining the old one for {XRAY_DRAIN_TIMEOUT} seconds")
+
+        return {
+            "mode": "overlap",
+            "fallback": False,
+            "overlap": round(time.monotonic() - readiness.created_at + XRAY_DRAIN_TIMEOUT, 3)
+        }
+
+    def restart(self, config: XRayConfig) -> dict:
+        """
+        Restarts the core with the config, while a core is running the config is tested first
+        and ConfigValidationError is raised without touching the running core if it's rejected
+        """
+        if self.restarting is True:
+            return {"mode": "skipped"}
+
+        self.restarting = True
+        start_time = time.perf_counter()
+        mode = "stop-start"
+        try:
+            validation = None
+            if XRAY_VALIDATE_CONFIG and self.started:
+                validation = VALIDATOR.validate(self, config)
+
+            with self._lock:
+                logger.warning("Restarting Xray core...")
+                if XRAY_RESTART_MODE == 'overlap' and self.started:
+                    mode = "overlap"
+                    return {**self._swap(config), "validation": validation}
+
+                self.stop()
+                self.start(config)
+                return {"mode": mode, "validation": validation}
         finally:
             self.restarting = False
+            RESTART_DURATION.observe(time.perf_counter() - start_time, mode=mode)
+
+    def _probe_api(self) -> bool:
+        """Checks whether the API inbound accepts TLS connections"""
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        try:
+            with socket.create_connection((self.api.address, self.api.port), timeout=0.5) as sock:
+                with context.wrap_socket(sock):
+                    return True
+        except OSError:
+            return False
+
+    def wait_ready(self, timeout: float = XRAY_START_TIMEOUT) -> float:
+        """
+        Blocks until the started core logs it's started line or it's API port accepts TLS connections
+        returns seconds it took the core to get ready since it was spawned,
+        raises RuntimeError as soon as the process exits and TimeoutError if it's still not ready after timeout
+        """
+        if self._readiness is None:
+            raise RuntimeError("Xray is not started")
+
+        return self._wait(self._readiness, timeout)
+
+    def _wait(self, readiness: Readiness, timeout: float, probe: bool = True) -> float:
+        deadline = time.monotonic() + timeout
+        while not readiness.wait(min(API_PROBE_INTERVAL, max(deadline - time.monotonic(), 0))):
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Xray did not get ready in {timeout} seconds")
+            if probe and self._probe_api():
+                readiness.set(ready=True)
+
+        if not readiness.ready:
+            raise RuntimeError(self.logs.last_line or "Xray exited")
+
+        time_to_ready = readiness.ready_at - readiness.created_at
+        if not readiness.observed:
+            readiness.observed = True
+            TIME_TO_READY.observe(time_to_ready)
+        return round(time_to_ready, 3)
+
+    def _collect_metrics(self):
+        subscribers = self.logs.stats()
+        yield ("marzban_node_xray_up", "gauge", "Whether Xray is running",
+               [({}, int(self.started))])
+        yield ("marzban_node_xray_crashes_total", "counter", "Unexpected Xray exits",
+               [({}, self.crashes)])
+        yield ("marzban_node_log_subscriber_lag", "gauge", "Lines waiting to be delivered to each log subscriber",
+               [({"subscriber": i}, s["lag"]) for i, s in enumerate(subscribers)])
+        yield ("marzban_node_log_subscriber_dropped_total", "counter", "Lines dropped for each log subscriber",
+               [({"subscriber": i}, s["dropped"]) for i, s in enumerate(subscribers)])
+
+        process = self.process
+        usage = sample_process(process.pid) if process is not None else {}
+        if usage:
+            yield ("marzban_node_xray_cpu_seconds_total", "counter", "CPU time used by Xray",
+                   [({}, usage["cpu_seconds"])])
+            yield ("marzban_node_xray_resident_memory_bytes", "gauge", "Resident memory of Xray",
+                   [({}, usage["resident_memory_bytes"])])
+            yield ("marzban_node_xray_threads", "gauge", "Threads of Xray",
+                   [({}, usage["threads"])])
+            yield ("marzban_node_xray_open_fds", "gauge", "Open file descriptors of Xray",
+                   [({}, usage["open_fds"])])
+
+    @property
+    def supervisor_stats(self) -> dict:
+        return {
+            "crashes": self.crashes,
+            "last_recovery_time": self.last_recovery_time
+        }
+
+    def get_stats(self, cursor: int = 0) -> dict:
+        if not self.started:
+            raise RuntimeError("Xray is not started")
+
+        try:
+            return self.stats.changes(cursor)
+        except XRayAPIError as exc:
+            raise RuntimeError(f"Failed to query stats: {exc.details}")
+
+    def get_stats_history(self, users: list = (), inbounds: list = (),
+                          start: float = 0, end: float = None, resolution: int = None) -> dict:
+        history = self.stats.history
+        result = history.query('user', users, start, end, resolution)
+        result["inbounds"] = history.query('inbound', inbounds, start, end, result["resolution"])["series"]
+        result["users"] = result.pop("series")
+        return result
+
+    def get_access_summary(self, limit: int = 20) -> dict:
+        if self.access is None:
+            raise RuntimeError("Access log aggregation is disabled")
+
+        return self.access.summary(limit)
+
+    def query_logs(self,
+                   start: float = None,
+                   end: float = None,
+                   history_since: int = None,
+                   history_until: int = None,
+                   log_filter: LogFilter = None,
+                   limit: int = 1000,
+                   chunk_size: int = 500):
+        """
+        Returns an iterator of (history next, lines) chunks of the spooled logs, see LogSpool.query
+        history seqs are the spool's sequence numbers, not the ones of the log bus
+        """
+        if self.spool is None:
+            raise RuntimeError("Log spool is disabled")
+
+        return self.spool.query(start, end, history_since, history_until, log_filter, limit, chunk_size)
+
+    def set_user_limits(self, limits: dict, replace: bool = False) -> dict:
+        self.enforcer.set_limits(limits, replace)
+        return {
+            "users": len(self.enforcer.limits),
+            "ip_limit_enforced": self.access is not None
+        }
+
+    def get_enforcement_events(self, after: int = 0, limit: int = 1000) -> dict:
+        return self.enforcer.get_events(after, limit)
+
+    def update(self, config: XRayConfig) -> dict:
+        result = self._update(config)
+        CONFIG_UPDATES.inc(strategy=result["strategy"])
+        return result
+
+    def _update(self, config: XRayConfig) -> dict:
+        """
+        Applies the config with the cheapest strategy and returns it's name along with restart details
+        noop: config is identical to the running one
+        hot: only clients have changed and were altered through the API
+        restart: core was restarted
+        """
+        # alter_users from the enforcer may change the clients while they're diffed otherwise
+        with self._lock:
+            if self.started and self.config is not None:
+                changes = self.config.diff(config)
+                if changes == {}:
+                    self.config = config
+                    return {"strategy": "noop"}
+
+                if changes is not None:
+                    result = self.alter_users(changes)
+                    if not result["errors"]:
+                        self.config = config
+                        return {"strategy": "hot"}
+                    logger.warning(f"Failed to apply client changes live, falling back to restart: {result['errors']}")
+
+        return {"strategy": "restart", **self.restart(config)}
+
+    def alter_users(self, inbounds: dict) -> dict:
+        """
+        Applies user additions and removals on the running core through HandlerService
+        inbounds maps inbound tags to {"add": [client, ...], "remove": [email, ...]}
+        """
+        with self._lock:
+            if not self.started or self.config is None:
+                raise RuntimeError("Xray is not started")
+
+            result = {"added": 0, "removed": 0, "errors": []}
+            for tag, changes in inbounds.items():
+                inbound = self.config.get_inbound(tag)
+                if inbound is None:
+                    result["errors"].append({"tag": tag, "error": "Inbound not found"})
+                    continue
+
+                for email in changes.get('remove', []):
+                    try:
+                        self.api.remove_inbound_user(tag, email)
+                    except EmailNotFoundError:
+                        pass
+                    except XRayAPIError as exc:
+                        result["errors"].append({"tag": tag, "email": email, "error": exc.details})
+                        continue
+                    self.config.remove_client(tag, email)
+                    result["removed"] += 1
+
+                for client in changes.get('add', []):
+                    try:
+                        account = build_account(inbound.get('protocol'), client, inbound.get('settings'))
+                        self.api.add_inbound_user(tag, client['email'], account, client.get('level', 0))
+                    except EmailExistsError:
+                        pass
+                    except KeyError as exc:
+                        result["errors"].append({"tag": tag, "error": f"Client is missing {exc}"})
+                        continue
+                    except XRayAPIError as exc:
+                        result["errors"].append({"tag": tag, "email": client.get('email'), "error": exc.details})
+                        continue
+                    self.config.add_client(tag, client)
+                    result["added"] += 1
+
+            return result
+
+    def remove_users(self, emails) -> tuple:
+        """
+        Removes the users from every inbound they're in on the running core,
+        returns {email: [inbound tag, ...]} of the users found along with alter_users' result
+        """
+        with self._lock:
+            inbounds = {}
+            for inbound in (self.config or {}).get('inbounds', []):
+                for client in inbound.get('settings', {}).get('clients', []) or []:
+                    if client.get('email') in emails:
+                        inbounds.setdefault(client['email'], []).append(inbound.get('tag'))
+
+            changes = {}
+            for email, tags in inbounds.items():
+                for tag in tags:
+                    changes.setdefault(tag, {"remove": []})["remove"].append(email)
+            return inbounds, self.alter_users(changes)
+
+    @staticmethod
+    def _run_hooks(funcs: list):
+        for func in funcs:
+            HOOKS_EXECUTOR.submit(func).add_done_callback(_log_hook_error)
 
     def on_start(self, func: callable):
         self._on_start_funcs.append(func)
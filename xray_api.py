@@ -0,0 +1,213 @@
+import re
+import threading
+
+import grpc
+from OpenSSL import crypto
+
+
+class XRayAPIError(Exception):
+    def __init__(self, details: str):
+        self.details = details
+        super().__init__(details)
+
+
+class EmailExistsError(XRayAPIError):
+    pass
+
+
+class EmailNotFoundError(XRayAPIError):
+    pass
+
+
+# the messages of Xray's inbound user managers, other errors like "handler not found: <tag>" must not match them
+EMAIL_EXISTS_PATTERN = re.compile(r'\bUser .* already exists\.?$')
+EMAIL_NOT_FOUND_PATTERN = re.compile(r'\bUser .* not found\.?$')
+
+
+def _varint(value: int) -> bytes:
+    value &= (1 << 64) - 1
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _bytes_field(number: int, value: bytes) -> bytes:
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def _string_field(number: int, value: str) -> bytes:
+    if not value:
+        return b''
+    return _bytes_field(number, value.encode())
+
+
+def _int_field(number: int, value: int) -> bytes:
+    if not value:
+        return b''
+    return _varint(number << 3) + _varint(value)
+
+
+def _read_varint(data: bytes, pos: int):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _parse_message(data: bytes):
+    """Yields (field number, value) pairs of a protobuf message"""
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = _read_varint(data, pos)
+            value, pos = data[pos:pos + length], pos + length
+        elif wire_type == 1:
+            value, pos = data[pos:pos + 8], pos + 8
+        elif wire_type == 5:
+            value, pos = data[pos:pos + 4], pos + 4
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type}")
+        yield number, value
+
+
+def typed_message(type_name: str, value: bytes) -> bytes:
+    return _string_field(1, type_name) + _bytes_field(2, value)
+
+
+SHADOWSOCKS_CIPHERS = {
+    "aes-128-gcm": 5,
+    "aes-256-gcm": 6,
+    "chacha20-poly1305": 7,
+    "chacha20-ietf-poly1305": 7,
+    "xchacha20-poly1305": 8,
+    "xchacha20-ietf-poly1305": 8,
+    "none": 9,
+    "plain": 9
+}
+
+
+def build_account(protocol: str, client: dict, settings: dict = None) -> bytes:
+    """Builds the TypedMessage account of a client defined as it's in the inbound's settings"""
+    settings = settings or {}
+
+    if protocol == 'vmess':
+        return typed_message("xray.proxy.vmess.Account",
+                             _string_field(1, client['id']))
+
+    if protocol == 'vless':
+        return typed_message("xray.proxy.vless.Account",
+                             _string_field(1, client['id']) + _string_field(2, client.get('flow', '')))
+
+    if protocol == 'trojan':
+        return typed_message("xray.proxy.trojan.Account",
+                             _string_field(1, client['password']))
+
+    if protocol == 'shadowsocks':
+        method = client.get('method') or settings.get('method', '')
+        if method.startswith('2022-'):
+            return typed_message("xray.proxy.shadowsocks_2022.Account",
+                                 _string_field(1, client['password']))
+
+        if method not in SHADOWSOCKS_CIPHERS:
+            raise XRayAPIError(f'Unsupported shadowsocks method "{method}"')
+        return typed_message("xray.proxy.shadowsocks.Account",
+                             _string_field(1, client['password'])
+                             + _int_field(2, SHADOWSOCKS_CIPHERS[method]))
+
+    raise XRayAPIError(f'Protocol "{protocol}" does not support users')
+
+
+class XRayAPI(object):
+    """
+    Minimal Xray gRPC API client
+    a single TLS channel is created lazily and shared by every call
+    """
+
+    def __init__(self, address: str, port: int, ssl_cert: str, timeout: float = 5):
+        self.address = address
+        self.port = port
+        self.ssl_cert = ssl_cert
+        self.timeout = timeout
+
+        self._channel = None
+        self._methods = {}
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        with open(self.ssl_cert, 'rb') as f:
+            cert = f.read()
+
+        target_name = crypto.load_certificate(crypto.FILETYPE_PEM, cert).get_subject().CN
+        credentials = grpc.ssl_channel_credentials(root_certificates=cert)
+        options = [('grpc.ssl_target_name_override', target_name)] if target_name else []
+        return grpc.secure_channel(f'{self.address}:{self.port}', credentials, options=options)
+
+    def _call(self, method: str, request: bytes) -> bytes:
+        with self._lock:
+            if self._channel is None:
+                self._channel = self._connect()
+            if method not in self._methods:
+                self._methods[method] = self._channel.unary_unary(method)
+            stub = self._methods[method]
+
+        try:
+            return stub(request, timeout=self.timeout)
+        except grpc.RpcError as exc:
+            details = exc.details() or str(exc.code())
+            if EMAIL_EXISTS_PATTERN.search(details):
+                raise EmailExistsError(details)
+            if EMAIL_NOT_FOUND_PATTERN.search(details):
+                raise EmailNotFoundError(details)
+            raise XRayAPIError(details)
+
+    def close(self):
+        with self._lock:
+            if self._channel is not None:
+                self._channel.close()
+            self._channel = None
+            self._methods = {}
+
+    def _alter_inbound(self, tag: str, operation: bytes):
+        request = _string_field(1, tag) + _bytes_field(2, operation)
+        self._call('/xray.app.proxyman.command.HandlerService/AlterInbound', request)
+
+    def add_inbound_user(self, tag: str, email: str, account: bytes, level: int = 0):
+        user = _int_field(1, level) + _string_field(2, email) + _bytes_field(3, account)
+        self._alter_inbound(tag, typed_message("xray.app.proxyman.command.AddUserOperation",
+                                               _bytes_field(1, user)))
+
+    def remove_inbound_user(self, tag: str, email: str):
+        self._alter_inbound(tag, typed_message("xray.app.proxyman.command.RemoveUserOperation",
+                                               _string_field(1, email)))
+
+    def remove_inbound(self, tag: str):
+        self._call('/xray.app.proxyman.command.HandlerService/RemoveInbound', _string_field(1, tag))
+
+    def query_stats(self, pattern: str = '', reset: bool = False) -> list:
+        """Returns (name, value) pairs of every counter matching the pattern"""
+        request = _string_field(1, pattern) + _int_field(2, int(reset))
+        response = self._call('/xray.app.stats.command.StatsService/QueryStats', request)
+
+        stats = []
+        for number, stat in _parse_message(response):
+            if number != 1:
+                continue
+            name, value = '', 0
+            for field, field_value in _parse_message(stat):
+                if field == 1:
+                    name = field_value.decode()
+                elif field == 2:
+                    value = field_value
+            stats.append((name, value))
+        return stats